@@ -0,0 +1,109 @@
+import threading
+import time
+import metrics
+from jobstore import account_key
+
+# Suno 帳號池：每個 cookie 是一個帳號，各自有客戶端、點數快照與進行中的生成數。
+# 點數與預留由 admission 管理，這裡只記錄帳號是否可用以及負載，讓工作分配到最空閒的帳號。
+# session 過期的帳號連續失敗後暫時移出帳號池，背景的點數更新成功時再放回。
+
+# Constants
+FAILURE_THRESHOLD = 3  # 連續失敗幾次後移出帳號池
+EJECT_SECONDS = 120  # 移出後至少經過多久才接受試探結果放回
+
+# 帳號狀態
+ACTIVE = "active"
+EJECTED = "ejected"
+
+_lock = threading.Lock()
+_accounts = {}  # cookie -> 帳號狀態
+_pool = []  # 目前設定中的帳號，依設定順序
+
+def parse_cookies(value):
+    # secrets 中可以是 TOML 陣列，或以換行分隔的字串（cookie 本身含有分號與逗號）
+    if isinstance(value, str):
+        value = value.splitlines()
+    return [cookie.strip() for cookie in value if cookie and cookie.strip()]
+
+def _entry(cookie):
+    entry = _accounts.get(cookie)
+    if entry is None:
+        entry = {"account": account_key(cookie), "state": ACTIVE, "in_flight": 0, "failures": 0,
+                 "ejected_at": 0.0, "jobs": 0, "errors": 0, "ejections": 0, "readmissions": 0}
+        _accounts[cookie] = entry
+    return entry
+
+def configure(cookies):
+    # 每次重跑都可以呼叫；secrets 更新後，移除的帳號不再接新工作，但進行中的工作照常完成
+    global _pool
+    with _lock:
+        for cookie in cookies:
+            _entry(cookie)
+        _pool = list(cookies)
+    return list(cookies)
+
+def pool():
+    with _lock:
+        return list(_pool)
+
+def active():
+    # 全部帳號都被移出時仍回傳整個帳號池，避免健康檢查誤判讓所有工作卡住
+    with _lock:
+        return [cookie for cookie in _pool if _accounts[cookie]["state"] == ACTIVE] or list(_pool)
+
+def is_active(cookie):
+    with _lock:
+        return _entry(cookie)["state"] == ACTIVE
+
+def in_flight(cookie):
+    with _lock:
+        return _entry(cookie)["in_flight"]
+
+def begin(cookie):
+    with _lock:
+        entry = _entry(cookie)
+        entry["in_flight"] += 1
+        entry["jobs"] += 1
+    metrics.gauge_add("song_suno_account_in_flight", {"account": entry["account"]})
+    metrics.inc("song_suno_account_jobs_total", {"account": entry["account"]})
+
+def end(cookie):
+    with _lock:
+        entry = _entry(cookie)
+        entry["in_flight"] = max(0, entry["in_flight"] - 1)
+    metrics.gauge_add("song_suno_account_in_flight", {"account": entry["account"]}, -1)
+
+def record_success(cookie):
+    with _lock:
+        entry = _entry(cookie)
+        entry["failures"] = 0
+        if entry["state"] != EJECTED or time.time() - entry["ejected_at"] < EJECT_SECONDS:
+            return
+        entry["state"] = ACTIVE
+        entry["readmissions"] += 1
+    metrics.inc("song_suno_account_readmissions_total", {"account": entry["account"]})
+
+def record_failure(cookie):
+    with _lock:
+        entry = _entry(cookie)
+        entry["failures"] += 1
+        entry["errors"] += 1
+        ejected = entry["state"] == ACTIVE and entry["failures"] >= FAILURE_THRESHOLD
+        if ejected:
+            entry["state"] = EJECTED
+            entry["ejected_at"] = time.time()
+            entry["ejections"] += 1
+    metrics.inc("song_suno_account_errors_total", {"account": entry["account"]})
+    if ejected:
+        metrics.inc("song_suno_account_ejections_total", {"account": entry["account"]})
+
+def account_stats():
+    # 以雜湊值代替 cookie 顯示，不在頁面或指標中洩漏憑證
+    with _lock:
+        return [dict(_accounts[cookie]) for cookie in _pool]
+
+metrics.describe("song_suno_account_in_flight", "gauge", "Suno generations currently running on each pooled account.")
+metrics.describe("song_suno_account_jobs_total", "counter", "Suno generations dispatched to each pooled account.")
+metrics.describe("song_suno_account_errors_total", "counter", "Failed Suno calls per pooled account.")
+metrics.describe("song_suno_account_ejections_total", "counter", "Times a pooled Suno account was ejected after repeated failures.")
+metrics.describe("song_suno_account_readmissions_total", "counter", "Times an ejected Suno account was re-admitted after a successful probe.")
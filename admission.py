@@ -0,0 +1,247 @@
+import threading
+import time
+from collections import deque
+import accounts
+from clients import get_suno_client
+
+# Constants
+CREDITS_PER_GENERATION = 10  # 每次 Suno generate 消耗的點數（一次產生兩首）
+CREDITS_REFRESH_INTERVAL = 60  # 背景更新點數的間隔秒數
+DISPATCH_INTERVAL = 0.5  # 排隊中的工作檢查間隔秒數
+
+# 每個上游各自的 token bucket：每秒補充的 token 數與最大累積數；Suno 的限制以帳號為單位
+RATE_LIMITS = {
+    "openai": (2.0, 10),
+    "suno": (0.2, 3),
+}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self):
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def wait_time(self, position=0):
+        # 排在第 position 位時，大約還要等多久才輪到
+        with self.lock:
+            self._refill()
+            missing = position + 1 - self.tokens
+            return max(0.0, missing / self.rate)
+
+    def acquire(self):
+        while not self.try_acquire():
+            time.sleep(self.wait_time())
+
+buckets = {"openai": TokenBucket(*RATE_LIMITS["openai"])}
+
+_lock = threading.Lock()
+_suno_buckets = {}  # cookie -> 該帳號的 token bucket
+_credits = {}  # cookie -> 最近一次的點數快照
+_reserved = {}  # cookie -> 已預留但尚未扣除的點數
+_refreshers = set()
+_queue = deque()  # 等待放行的工作
+_dispatcher = None
+_stats = {"admitted": 0, "queued": 0, "rejected": 0, "credit_refreshes": 0, "credit_errors": 0}
+
+def wait_time(upstream):
+    return buckets[upstream].wait_time()
+
+def acquire(upstream):
+    buckets[upstream].acquire()
+
+def suno_bucket(cookie):
+    bucket = _suno_buckets.get(cookie)
+    if bucket is None:
+        bucket = _suno_buckets.setdefault(cookie, TokenBucket(*RATE_LIMITS["suno"]))
+    return bucket
+
+def refresh_credits(cookie):
+    try:
+        info = get_suno_client(cookie).get_credits()
+        snapshot = {
+            "credits_left": info.credits_left,
+            "period": info.period,
+            "monthly_limit": info.monthly_limit,
+            "monthly_usage": info.monthly_usage,
+            "fetched_at": time.time(),
+        }
+    except Exception:
+        with _lock:
+            _stats["credit_errors"] += 1
+        accounts.record_failure(cookie)
+        return None
+    with _lock:
+        _credits[cookie] = snapshot
+        _stats["credit_refreshes"] += 1
+    # 點數更新同時是帳號的健康檢查，被移出的帳號在這裡放回帳號池
+    accounts.record_success(cookie)
+    return snapshot
+
+def _refresh_loop(cookie):
+    while True:
+        refresh_credits(cookie)
+        time.sleep(CREDITS_REFRESH_INTERVAL)
+
+def start_credit_refresh(cookie):
+    # 每個憑證一個背景執行緒定期更新點數，頁面只讀取快照
+    with _lock:
+        if cookie in _refreshers:
+            return
+        _refreshers.add(cookie)
+    threading.Thread(target=_refresh_loop, args=(cookie,), name="credit-refresh", daemon=True).start()
+
+def credits_snapshot(cookie):
+    with _lock:
+        snapshot = _credits.get(cookie)
+        if not snapshot:
+            return None
+        return {**snapshot, "reserved": _reserved.get(cookie, 0)}
+
+def pool_credits():
+    # 帳號池中所有帳號的點數合計，還沒取得快照的帳號不計入
+    snapshots = [credits_snapshot(cookie) for cookie in accounts.pool()]
+    snapshots = [snapshot for snapshot in snapshots if snapshot]
+    if not snapshots:
+        return None
+    return {field: sum(snapshot[field] for snapshot in snapshots)
+            for field in ("credits_left", "reserved", "monthly_usage", "monthly_limit")}
+
+def _available_credits(cookie):
+    # 還沒取得快照時不阻擋，避免點數 API 故障讓所有工作卡住
+    snapshot = _credits.get(cookie)
+    if not snapshot:
+        return None
+    return snapshot["credits_left"] - _reserved.get(cookie, 0)
+
+def enqueue(ticket, cookie, run, on_reject):
+    # cookie 為 None 時由帳號池挑選帳號；run(cookie) 在放行時以選中的帳號呼叫，點數永遠不夠時呼叫 on_reject(message)
+    for account in [cookie] if cookie else accounts.pool():
+        start_credit_refresh(account)
+    with _lock:
+        _queue.append({"ticket": ticket, "cookie": cookie, "run": run, "on_reject": on_reject,
+                       "queued_at": time.time()})
+        _stats["queued"] += 1
+    _ensure_dispatcher()
+
+def release(cookie):
+    # 生成結束後先更新快照再釋放預留點數，避免短暫重複計算可用點數
+    refresh_credits(cookie)
+    with _lock:
+        _reserved[cookie] = max(0, _reserved.get(cookie, 0) - CREDITS_PER_GENERATION)
+    accounts.end(cookie)
+
+def _ensure_dispatcher():
+    global _dispatcher
+    with _lock:
+        if _dispatcher is not None:
+            return
+        _dispatcher = threading.Thread(target=_dispatch_loop, name="admission", daemon=True)
+        _dispatcher.start()
+
+def _funded(cookies):
+    # 點數足夠的帳號；還沒取得快照的帳號不阻擋，避免點數 API 故障讓所有工作卡住
+    funded = []
+    for cookie in cookies:
+        available = _available_credits(cookie)
+        if available is None or available >= CREDITS_PER_GENERATION:
+            funded.append(cookie)
+    return funded
+
+def _pick_account(cookies):
+    # 在 _lock 內呼叫：進行中最少的帳號優先，其次是可用點數最多的，並取得該帳號的速率限制 token。
+    # 回傳 (帳號, 是否已無希望)；所有帳號都點數不足且沒有任何預留時，等待也不會有結果
+    funded = _funded(cookies)
+    if not funded:
+        return None, bool(cookies) and not any(_reserved.get(cookie, 0) for cookie in cookies)
+    funded.sort(key=lambda cookie: (accounts.in_flight(cookie), -(_available_credits(cookie) or 0)))
+    for cookie in funded:
+        if suno_bucket(cookie).try_acquire():
+            _reserved[cookie] = _reserved.get(cookie, 0) + CREDITS_PER_GENERATION
+            _stats["admitted"] += 1
+            accounts.begin(cookie)
+            return cookie, False
+    return None, False
+
+def _next_admitted():
+    with _lock:
+        if not _queue:
+            return None, None, None
+        entry = _queue[0]
+        # 接續舊工作時只能使用原本的帳號
+        cookie, exhausted = _pick_account([entry["cookie"]] if entry["cookie"] else accounts.active())
+        if exhausted:
+            _queue.popleft()
+            _stats["rejected"] += 1
+            return None, None, entry
+        if not cookie:
+            return None, None, None
+        _queue.popleft()
+        return entry, cookie, None
+
+def acquire_account():
+    # 批次流程同步取得帳號並預留點數，生成結束後呼叫 release(cookie)
+    for cookie in accounts.pool():
+        start_credit_refresh(cookie)
+    while True:
+        with _lock:
+            cookie, exhausted = _pick_account(accounts.active())
+        if exhausted:
+            raise RuntimeError("Suno 點數不足，無法生成歌曲。")
+        if cookie:
+            return cookie
+        time.sleep(DISPATCH_INTERVAL)
+
+def _dispatch_loop():
+    global _dispatcher
+    while True:
+        entry, cookie, rejected = _next_admitted()
+        if rejected:
+            rejected["on_reject"]("Suno 點數不足，無法生成歌曲。")
+            continue
+        if entry:
+            entry["run"](cookie)
+            continue
+        with _lock:
+            if not _queue:
+                _dispatcher = None
+                return
+        time.sleep(DISPATCH_INTERVAL)
+
+def queue_info(ticket):
+    # 回傳排隊位置與預估等待秒數；點數不足而需等待其他工作結束時 ETA 為 None
+    with _lock:
+        for position, entry in enumerate(_queue):
+            if entry["ticket"] == ticket:
+                break
+        else:
+            return None
+        funded = _funded([entry["cookie"]] if entry["cookie"] else accounts.active())
+    if not funded:
+        return {"position": position, "eta": None}
+    # 排在前面的工作平均分配到各個帳號
+    return {"position": position,
+            "eta": min(suno_bucket(cookie).wait_time(position // len(funded)) for cookie in funded)}
+
+def admission_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["waiting"] = len(_queue)
+        stats["reserved"] = sum(_reserved.values())
+    stats["openai_wait"] = buckets["openai"].wait_time()
+    stats["suno_wait"] = min((suno_bucket(cookie).wait_time() for cookie in accounts.active()), default=0.0)
+    return stats
@@ -1,195 +1,534 @@
+import html
+import os
 import time
 import streamlit as st
+import streamlit.components.v1 as components
 import json
-from openai import OpenAI
-from suno import Suno, ModelVersions
+import metrics
+from cache import cache_get, cache_put, cache_stats
+import singleflight
+from resilience import UpstreamError, resilience_stats
+import accounts
+from admission import start_credit_refresh, credits_snapshot, pool_credits, queue_info, admission_stats, wait_time
+from media import media_url, media_path, is_cached, media_stats
+from transport import transport_stats
+from renderer import renderer_stats
+from waveform import load_waveform, waveform_stats
+from mastering import mastering_stats, served_ext
+from clients import get_suno_client, get_openai_client, client_stats
+from jobs import (submit_music_job, get_job, job_stats, resume_jobs, add_listener, QUEUED, GENERATING, WAITING_VIDEO,
+                  DONE, FAILED, TIMEOUT, FINISHED_STATES)
+
+from styles import list_styles, get_style, DEFAULT_STYLE
+from generation import (generate_lyrics, generate_lyrics_stream,
+                        generate_theme, generate_lyrics_and_theme, ensure_structure, lyrics_cache_key,
+                        song_cache_key, theme_cache_key, prompt_stats)
+from structure import structure_stats
+import status
+import history
 
 # Constants
-MAX_TITLE_LENGTH = 100
 CHECK_INTERVAL = 5  # 檢查間隔秒數
+WAVEFORM_WIDTH = 600  # 波形的點數
+WAVEFORM_HEIGHT = 60
+WAVEFORM_TICK = 30  # 每 30 秒一條刻度線
+STATUS_PUSH_FAILED = "push_failed"  # 推送元件連不到狀態伺服器時回傳的值
+PAGE_GENERATE = "generate"
+PAGE_HISTORY = "history"
+
+# 訂閱工作狀態推送的前端元件，只在工作狀態改變時觸發重跑
+job_status_component = components.declare_component(
+    "job_status", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "job_status")
+)
 
 # OpenAI API 設置
 openai_api_key = st.secrets["OPENAI_API_KEY"]
-client = OpenAI(api_key=openai_api_key)
+client = get_openai_client(openai_api_key)
 
-def initialize_suno_client():
-    try:
-        return Suno(
-            cookie=st.secrets["SUNO_COOKIE"],
-            model_version=ModelVersions.CHIRP_V3_5
-        )
-    except Exception as e:
-        st.error(f"初始化Suno客戶端時出錯: {str(e)}")
-        return None
-
-def generate_lyrics(all_selections):
-    prompt = f"""你是[世界頂尖的國語歌詞創作大師]，請你寫一首[充滿溫暖、浪漫、緩慢、有感情]的中文歌詞。
-    描述[{all_selections}]。
-    音樂的風格是[六十年代國語歌曲風]。
-    詞曲的結構是[Verse1]-[Chorus]-[Verse2]-[Chorus]-[Bride]-[Chorus]-[Outro](結構兩旁要加上方號[]，並與上一段有一個空格)
-    最前面加上 [intro] 最後面加上[End]"""
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a professional Taiwanese song lyricist."},
-            {"role": "user", "content": prompt}
-        ]
-    )
-    return response.choices[0].message.content
-
-def generate_theme(lyrics):
-    prompt = f"""根據以下歌詞，給出一個適合的歌曲主題：
-    {lyrics}
-    請提供一個簡潔而富有意境的主題。"""
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a professional song theme creator."},
-            {"role": "user", "content": prompt}
-        ]
+def suno_cookies():
+    # SUNO_COOKIES 設定多個帳號時組成帳號池，否則只使用 SUNO_COOKIE 一個帳號
+    if "SUNO_COOKIES" in st.secrets:
+        return accounts.configure(accounts.parse_cookies(st.secrets["SUNO_COOKIES"]))
+    return accounts.configure([st.secrets["SUNO_COOKIE"]])
+
+def initialize_suno_clients(cookies):
+    # 進程內共用的客戶端，只有在 session 過期時才會重建；回傳可用的帳號數。
+    # 被移出的帳號不在每次重跑時重建客戶端，由背景的點數更新試探，成功後放回帳號池
+    ready = 0
+    errors = []
+    active = [cookie for cookie in cookies if accounts.is_active(cookie)]
+    if not active:
+        st.error("所有 Suno 帳號暫時無法使用，請稍後再試。")
+        return 0
+    for cookie in active:
+        try:
+            get_suno_client(cookie)
+            ready += 1
+        except Exception as e:
+            accounts.record_failure(cookie)
+            errors.append(str(e))
+    if not ready and errors:
+        st.error(f"初始化Suno客戶端時出錯: {errors[0]}")
+    elif errors:
+        st.warning(f"{len(errors)} 個 Suno 帳號初始化失敗，改用其餘 {ready} 個帳號。")
+    return ready
+
+def waveform_svg(seconds_per_point, mins, maxs, marker=None):
+    # 用預先算好的峰值畫出波形，不必在頁面上解碼音檔
+    middle = WAVEFORM_HEIGHT / 2
+    scale = middle / 128
+    top = " ".join(f"{x},{middle - int(value) * scale:.1f}" for x, value in enumerate(maxs))
+    bottom = " ".join(f"{x},{middle - int(value) * scale:.1f}" for x, value in reversed(list(enumerate(mins))))
+    width = len(maxs)
+    ticks = "".join(
+        f'<line x1="{x:.1f}" y1="0" x2="{x:.1f}" y2="{WAVEFORM_HEIGHT}" stroke="#ddd" />'
+        for x in (seconds / seconds_per_point for seconds in range(WAVEFORM_TICK, int(width * seconds_per_point), WAVEFORM_TICK))
     )
-    return response.choices[0].message.content
-
-def generate_music(suno_client, lyrics, theme):
-    try:
-        clips = suno_client.generate(
-            prompt=lyrics,
-            tags="六十年代國語歌曲風, 國語歌手, 民歌腔,民謠風, 國語歌",
-            title=theme[:MAX_TITLE_LENGTH],
-            make_instrumental=False,
-            is_custom=True,
-            wait_audio=True
-        )
-        if clips and clips[0].audio_url:
-            return clips[0]
-    except Exception as e:
-        st.error(f"生成歌曲時發生錯誤: {str(e)}")
-    return None
-
-def check_video_url(suno_client, clip_id):
-    try:
-        songs = suno_client.get_songs(song_ids=f"{clip_id}")
-        if songs and len(songs) > 0:
-            return songs[0].video_url
-    except Exception as e:
-        st.error(f"檢查視頻URL時發生錯誤: {str(e)}")
-    return None
+    if marker:
+        x = marker / seconds_per_point
+        ticks += f'<line x1="{x:.1f}" y1="0" x2="{x:.1f}" y2="{WAVEFORM_HEIGHT}" stroke="#e4572e" stroke-width="2" />'
+    return (f'<svg viewBox="0 0 {width} {WAVEFORM_HEIGHT}" preserveAspectRatio="none" width="100%" height="{WAVEFORM_HEIGHT}">'
+            f'{ticks}<polygon points="{top} {bottom}" fill="#4a6fa5" /></svg>')
+
+def render_audio(clip):
+    # 有播放中檔案的波形時顯示波形與跳轉滑桿，播放器從選擇的位置開始播放
+    start_time = 0
+    ext = served_ext(clip["id"])
+    waveform = load_waveform(clip["id"], ext, WAVEFORM_WIDTH)
+    if waveform:
+        seconds_per_point, mins, maxs = waveform
+        duration = int(len(maxs) * seconds_per_point)
+        start_time = st.slider("跳到(Seek)", 0, max(1, duration), 0, format="%d 秒", key=f'seek_{clip["id"]}')
+        st.markdown(waveform_svg(seconds_per_point, mins, maxs, start_time), unsafe_allow_html=True)
+    # 本地媒體有公開網址時播放後製過的版本或本地原始音檔，否則播放 CDN 的原始音檔
+    audio_url = media_url(clip["id"], ext, clip["audio_url"])
+    st.audio(audio_url, format='audio/mp3', start_time=start_time)
+
+def render_music_job(job_id, live=False):
+    # 只讀取背景工作的狀態，不在腳本執行緒中等待；live 時排隊與等待的進度由推送元件即時顯示
+    job = get_job(job_id)
+    if not job:
+        st.warning('找不到生成工作，請重新生成。')
+        return
+    if live and job["status"] in (QUEUED, GENERATING):
+        return
+    if job["status"] == QUEUED:
+        info = queue_info(job_id)
+        if info and info["eta"] is None:
+            st.info(f'排隊中(Queued)，前面還有 {info["position"]} 個工作，等待其他工作釋放點數...')
+        elif info:
+            st.info(f'排隊中(Queued)，前面還有 {info["position"]} 個工作，預計 {info["eta"]:.0f} 秒後開始。')
+        else:
+            st.info('排隊中(Queued)...')
+        return
+    if job["status"] == GENERATING:
+        st.info('正在生成音樂(Music generating)...')
+        return
+    if job["status"] == FAILED:
+        st.error(job["error"])
+        return
+
+    st.success(f'音樂生成成功! 共 {len(job["clips"])} 個版本')
+    for index, clip in enumerate(job["clips"], start=1):
+        st.subheader(f"版本 {index}(Variant {index})")
+        st.caption(f'Clip ID: {clip["id"]}')
+        render_audio(clip)
+        if clip["status"] == WAITING_VIDEO and not live:
+            st.info(f'影片生成中(Video Generating)，請稍候... (已檢查 {clip["video_checks"]} 次)')
+        elif clip["status"] == DONE:
+            st.success(f'影片已生成: {clip["video_url"] or "本地繪製(Rendered locally)"}')
+        elif clip["status"] == TIMEOUT:
+            st.warning('影片生成超時，請稍後再試。')
+
+def render_video_players(job):
+    # 每個有影片的版本各自一個播放按鈕
+    for index, clip in enumerate(job["clips"], start=1):
+        if not clip["video_url"] and not is_cached(clip["id"], "mp4"):
+            continue
+        if st.button(f'播放影片 版本 {index}(Play video {index})', key=f'play_{clip["id"]}'):
+            video_url = media_url(clip["id"], "mp4", clip["video_url"])
+            if not video_url:
+                # 只有本地繪製的影片、還沒有 Suno 網址時，由 Streamlit 直接提供檔案
+                st.video(media_path(clip["id"], "mp4"))
+                continue
+            video_html = f"""
+                <video controls width="100%">
+                <source src="{video_url}" type="video/mp4">
+                您的浏览器不支持video标签。
+                </video>
+            """
+            st.markdown(video_html, unsafe_allow_html=True)
+
+@st.fragment(run_every=CHECK_INTERVAL)
+def music_job_status():
+    job_id = st.session_state.job_id
+    render_music_job(job_id)
+    job = get_job(job_id)
+    # 工作結束後重跑整頁一次，讓播放按鈕出現並停止定時刷新
+    if job and job["status"] in FINISHED_STATES and not st.session_state.job_finished:
+        st.session_state.job_finished = True
+        st.rerun()
+
+def music_job_live(job):
+    # 瀏覽器直接訂閱狀態推送，等待期間沒有任何腳本在執行；狀態改變時元件回傳新值觸發一次重跑
+    render_music_job(job["id"], live=True)
+    signature = ",".join([job["status"], *(clip["status"] for clip in job["clips"])])
+    value = job_status_component(url=status.status_url(job["id"]), signature=signature, key=f'status_{job["id"]}',
+                                 default=None)
+    if value == STATUS_PUSH_FAILED:
+        # 這個瀏覽器連不到狀態伺服器，這個 session 之後都改用定時重跑
+        st.session_state.status_push_failed = True
+        st.rerun()
+
+def show_structure_report(changes, issues):
+    # 段落標記在本地修復時簡短說明改了什麼，仍有問題時提醒使用者手動調整
+    if changes:
+        st.caption(f"已修正歌詞結構: {'；'.join(changes)}")
+    if issues:
+        st.warning(f"歌詞結構仍有問題，請手動調整: {'；'.join(issues)}")
+
+def show_account_stats(cookies):
+    # 只有一個帳號時不顯示帳號池
+    if len(cookies) < 2:
+        return
+    with st.sidebar.expander(f"Suno 帳號池(Account pool): {len(accounts.active())} / {len(cookies)} 可用"):
+        for cookie, stats in zip(cookies, accounts.account_stats()):
+            credits_info = credits_snapshot(cookie)
+            credits_left = credits_info["credits_left"] - credits_info["reserved"] if credits_info else "-"
+            st.write(f"{stats['account'][:8]}: {'可用' if stats['state'] == accounts.ACTIVE else '已移出'}，"
+                     f"進行中 {stats['in_flight']}，可用點數 {credits_left}，已分配 {stats['jobs']}，"
+                     f"錯誤 {stats['errors']}，移出 {stats['ejections']} 次")
+
+def show_client_stats(stats_before):
+    stats = client_stats()
+    with st.sidebar.expander("客戶端統計(Client stats)"):
+        st.write(f"本次互動建立 Suno 客戶端次數: {stats['suno_constructions'] - stats_before['suno_constructions']}")
+        st.write(f"本次互動握手耗時: {stats['suno_handshake_seconds'] - stats_before['suno_handshake_seconds']:.3f} 秒")
+        st.write(f"累計建立次數: {stats['suno_constructions']}，重用次數: {stats['suno_reuses']}")
+        st.write(f"平均握手耗時: {stats['suno_avg_handshake_seconds']:.3f} 秒")
+    stats = job_stats()
+    with st.sidebar.expander("影片輪詢統計(Video poller stats)"):
+        st.write(f"進行中的工作: {stats['active_jobs']}，等待影片的 clip: {stats['pending']}")
+        st.write(f"上游 get_songs 呼叫次數: {stats['upstream_calls']}，查詢 clip 次數: {stats['clips_checked']}")
+        st.write(f"影片完成: {stats['clips_ready']}，超時: {stats['clips_timed_out']}，錯誤: {stats['errors']}")
+    stats = admission_stats()
+    with st.sidebar.expander("排隊與限流統計(Admission stats)"):
+        st.write(f"排隊中: {stats['waiting']}，已放行: {stats['admitted']}，點數不足拒絕: {stats['rejected']}")
+        st.write(f"預留點數: {stats['reserved']}，點數更新: {stats['credit_refreshes']}，錯誤: {stats['credit_errors']}")
+        st.write(f"OpenAI 等待: {stats['openai_wait']:.1f} 秒，Suno 等待: {stats['suno_wait']:.1f} 秒")
+    with st.sidebar.expander("各階段延遲(Stage latency)"):
+        for stage in ("lyrics", "theme", "lyrics_and_theme", "lyrics_fix", "suno", "video_poll", "mastering", "waveform", "render"):
+            p50, p95, p99 = (metrics.quantile("song_stage_duration_seconds", q, {"stage": stage}) for q in (0.5, 0.95, 0.99))
+            if p50 is not None:
+                st.write(f"{stage}: p50 ≤ {p50} 秒，p95 ≤ {p95} 秒，p99 ≤ {p99} 秒")
+        st.caption(f"Prometheus: http://localhost:{metrics.METRICS_PORT}/metrics")
+    stats = cache_stats()
+    with st.sidebar.expander("快取統計(Cache stats)"):
+        st.write(f"命中: {stats['hits']}，未命中: {stats['misses']}，命中率: {stats['hit_rate']:.0%}")
+        st.write(f"寫入: {stats['writes']}，淘汰: {stats['evictions']}")
+    stats = renderer_stats()
+    with st.sidebar.expander("本地媒體處理(Local media processing)"):
+        if stats["enabled"]:
+            st.write(f"影片已繪製: {stats['rendered']}，失敗: {stats['errors']}，平均 {stats['avg_seconds']:.1f} 秒")
+        else:
+            st.write("本地影片繪製未啟用（找不到 ffmpeg 或 LOCAL_VIDEO_RENDER=0），改為等待 Suno 影片。")
+        stats = mastering_stats()
+        if stats["enabled"]:
+            st.write(f"音檔後製: {stats['processed']}，失敗: {stats['errors']}，平均 {stats['avg_seconds']:.1f} 秒，"
+                     f"共去除 {stats['trimmed_seconds']:.0f} 秒靜音")
+        stats = waveform_stats()
+        st.write(f"波形已計算: {stats['computed']}，失敗: {stats['errors']}，解碼音檔共 {stats['decoded_seconds']:.0f} 秒")
+        stats = media_stats()
+        st.write(f"媒體庫: {stats['stored_bytes'] / 1024 ** 2:.1f} MB，下載 {stats['downloads']} 次，命中 {stats['hits']} 次")
+    stats = transport_stats()
+    with st.sidebar.expander("連線池統計(Connection pool stats)"):
+        st.write(f"OpenAI 請求: {stats['httpx_requests']}，新連線: {stats['httpx_connections']}（HTTP/2: {'是' if stats['http2'] else '否'}）")
+        st.write(f"Suno 與媒體請求: {stats['requests_requests']}，新連線: {stats['requests_connections']}")
+        st.write(f"連線重用率: {stats['reuse_ratio']:.0%}，省下的 TLS 握手: {stats['tls_handshakes_saved']}")
+    stats = resilience_stats()
+    with st.sidebar.expander("OpenAI 避險與斷路(Hedging and circuit breaker)"):
+        st.write(f"請求: {stats['calls']}，避險請求: {stats['hedges']}，避險勝出: {stats['hedge_wins']}（{stats['hedge_win_rate']:.0%}）")
+        st.write(f"逾時: {stats['deadline_exceeded']}，失敗: {stats['failures']}，斷路快速失敗: {stats['fast_failures']}")
+        st.write(f"斷路器狀態: {stats['openai_circuit']}")
+    stats = prompt_stats()
+    with st.sidebar.expander("提示詞用量(Prompt tokens)"):
+        st.write(f"請求: {stats['requests']}，平均輸入 token: {stats['avg_prompt_tokens']:.0f}")
+        st.write(f"快取命中 token: {stats['cached_tokens']}（{stats['cached_ratio']:.0%}），固定前綴佔比: {stats['prefix_ratio']:.0%}")
+    stats = status.status_stats()
+    with st.sidebar.expander("狀態推送(Status push)"):
+        if stats["enabled"]:
+            st.write(f"訂閱中的頁面: {stats['subscribers']}，推送事件: {stats['events_sent']}，長輪詢: {stats['long_polls']}")
+            st.write(f"工作狀態更新: {stats['published']}")
+        else:
+            st.write(f"狀態推送未啟用，改為每 {CHECK_INTERVAL} 秒重跑一次。")
+    stats = structure_stats()
+    with st.sidebar.expander("歌詞結構檢查(Lyrics structure)"):
+        st.write(f"檢查: {stats['checked']}，結構正確: {stats['valid']}，本地修復: {stats['repaired']}")
+        st.write(f"需要模型修正: {stats['needs_llm']}，成功: {stats['llm_fixed']}，失敗: {stats['llm_failed']}")
+        st.write(f"本地修復率: {stats['local_fix_rate']:.0%}")
+    stats = singleflight.singleflight_stats()
+    with st.sidebar.expander("請求合併統計(Coalescing stats)"):
+        st.write(f"實際送出: {stats['leaders']}，合併: {stats['collapsed']}，合併率: {stats['collapse_rate']:.0%}")
+        st.write(f"進行中: {stats['in_flight']}，錯誤: {stats['errors']}")
+
+def render_history_song(song, styles):
+    # 音檔與影片只放 preload="none" 的播放器，使用者按下播放才開始下載，一頁的歌曲再多也不會一次載入媒體
+    with st.container(border=True):
+        st.subheader(song["theme"])
+        style_name = styles[song["style"]]["name"] if song["style"] in styles else song["style"] or "-"
+        st.caption(f'{time.strftime("%Y-%m-%d %H:%M", time.localtime(song["created_at"]))}，{style_name}，'
+                   f'工作 ID: {song["song_id"]}')
+        selected = [f"{category}: {'、'.join(options)}" for category, options in song["selections"].items() if options]
+        if selected:
+            st.write("；".join(selected))
+        with st.expander("歌詞(Lyrics)"):
+            st.text(song["lyrics"])
+        for index, clip in enumerate(song["clips"], start=1):
+            audio_url = media_url(clip["id"], served_ext(clip["id"]), clip["audio_url"])
+            media_html = f'<div>版本 {index}</div><audio controls preload="none" src="{html.escape(audio_url)}" style="width: 100%"></audio>'
+            video_url = media_url(clip["id"], "mp4", clip.get("video_url"))
+            if video_url:
+                media_html += f'<video controls preload="none" width="100%" src="{html.escape(video_url)}"></video>'
+            st.markdown(media_html, unsafe_allow_html=True)
+
+def history_page(direction):
+    # cursors 是已瀏覽過的每一頁的 cursor，上一頁直接取回，不必用 OFFSET 重新掃描
+    cursors = st.session_state.history_cursors
+    if direction > 0:
+        cursors.append(st.session_state.history_next)
+    elif len(cursors) > 1:
+        cursors.pop()
+
+def render_history(styles):
+    st.title("歌曲庫(Song history)")
+    query = st.text_input("搜尋歌詞、主題、選擇或 Clip ID(Search)", key="history_query").strip()
+    style_column, category_column, option_column = st.columns(3)
+    style_filter = style_column.selectbox("風格(Style)", [None, *styles], key="history_style",
+                                          format_func=lambda style_id: styles[style_id]["name"] if style_id else "全部")
+    if style_filter:
+        categories = list(styles[style_filter]["categories"])
+    else:
+        categories = list(dict.fromkeys(category for style in styles.values() for category in style["categories"]))
+    category = category_column.selectbox("類別(Category)", [None, *categories], key="history_category",
+                                         format_func=lambda category: category or "全部")
+    option = option_column.selectbox("選項(Option)", [None, *(history.options(category) if category else [])],
+                                     key="history_option", format_func=lambda option: option or "全部")
+    # 篩選條件改變時回到第一頁
+    filters = (query, style_filter, category, option)
+    if st.session_state.get("history_filters") != filters:
+        st.session_state.history_filters = filters
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    songs, st.session_state.history_next = history.page(query, style_filter, category, option, cursors[-1])
+    if not songs:
+        st.info("沒有符合的歌曲。")
+    for song in songs:
+        render_history_song(song, styles)
+    previous_column, page_column, next_column = st.columns(3)
+    previous_column.button("上一頁(Previous)", disabled=len(cursors) == 1, on_click=history_page, args=(-1,))
+    page_column.caption(f"第 {len(cursors)} 頁")
+    next_column.button("下一頁(Next)", disabled=st.session_state.history_next is None, on_click=history_page, args=(1,))
+    stats = history.history_stats()
+    st.caption(f"歌曲庫共 {stats['songs']} 首，平均查詢 {stats['avg_query_ms']:.1f} 毫秒")
 
 def main():
-    st.title("音樂歌曲生成器(Music Generator)")
+    # 一個進程服務所有風格，共用客戶端與快取
+    styles = list_styles()
+    # 完成的工作寫入歌曲庫；之前只存在工作紀錄中的歌曲第一次執行時補進來
+    add_listener(history.record_job)
+    history.backfill()
+    page = st.sidebar.radio("頁面(Page)", [PAGE_GENERATE, PAGE_HISTORY],
+                            format_func=lambda page: "生成歌曲(Generate)" if page == PAGE_GENERATE else "歌曲庫(History)")
+    if page == PAGE_HISTORY:
+        render_history(styles)
+        return
+    style_id = st.sidebar.selectbox(
+        "風格(Style)",
+        list(styles),
+        index=list(styles).index(DEFAULT_STYLE),
+        format_func=lambda style_id: styles[style_id]["name"]
+    )
+    style = get_style(style_id)
+    st.title(style.get("title", "音樂歌曲生成器(Music Generator)"))
+    stats_before = client_stats()
+    metrics.start_server()
 
     # 使用 session_state 來保存狀態
-    if 'clip' not in st.session_state:
-        st.session_state.clip = None
-    if 'video_url' not in st.session_state:
-        st.session_state.video_url = None
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None
+    if 'job_finished' not in st.session_state:
+        st.session_state.job_finished = False
     if 'lyrics' not in st.session_state:
         st.session_state.lyrics = None
     if 'theme' not in st.session_state:
         st.session_state.theme = None
 
-    categories = {
-        "主題(Themes)": ["回憶過往", "晚年幸福", "金婚紀念", "孫兒相伴", "永恆的愛"],
-        "心情(Moods)": ["溫暖", "感恩", "柔情", "幸福", "懷舊"],
-        "時間(Time)": ["天光", "日頭赤炎炎", "三更半暝", "黃昏", "透早"],
-        "物品(Items)": ["老照片", "手織毛衣", "古董鐘錶", "婚戒", "祖傳首飾"],
-        "場景(Scene)": ["櫻花樹下", "古老庭院", "夕陽下的長椅", "餐廳裡的燭光晚餐", "鄉間小路"],
-        "人物(People)": ["摯愛伴侶", "親密好友", "孫兒", "子女", "相伴一生的人"]
-    }
+    # 伺服器重啟後接續未完成的工作，並讓重新整理的分頁依網址中的工作 ID 重新連接
+    cookies = suno_cookies()
+    resume_jobs(cookies)
+    attach_id = st.sidebar.text_input("重新連接工作(Job ID)", value=st.query_params.get("job", "")).strip()
+    if attach_id and attach_id != st.session_state.job_id:
+        if get_job(attach_id):
+            st.session_state.job_id = attach_id
+            st.session_state.job_finished = False
+            st.query_params["job"] = attach_id
+        else:
+            st.sidebar.warning('找不到這個工作 ID。')
+    if st.session_state.job_id:
+        st.sidebar.caption(f"目前工作 ID: {st.session_state.job_id}")
 
     selections = {}
-    for category, options in categories.items():
+    for category, options in style["categories"].items():
         st.subheader(f"{category}")
         selected = st.multiselect(
             f"選擇一個或多個{category}：",
             options,
-            key=f"{category}_multiselect"
+            key=f"{style_id}_{category}_multiselect"
         )
         
-        custom_input = st.text_input(f"輸入自定義{category}（多個請用逗號分隔）：", key=f"{category}_custom")
+        custom_input = st.text_input(f"輸入自定義{category}（多個請用逗號分隔）：", key=f"{style_id}_{category}_custom")
         if custom_input:
             custom_options = [option.strip() for option in custom_input.split(',')]
             selected.extend(custom_options)
         
         selections[category] = selected
 
+    stream_lyrics = st.checkbox("串流顯示歌詞(Stream lyrics)", value=True)
+    combined_mode = st.checkbox("一次生成歌詞和主題(Single request)", value=False)
+    # 重新生成時也不與其他人進行中的相同請求合併，確保拿到新的版本
+    regenerate = st.checkbox("重新生成，不使用快取(Regenerate)", value=False)
+
     if st.button("生成歌詞和主題(Generate Lyrics and Themes)"):
+        if wait_time("openai") > 0:
+            st.info(f'請求較多，預計等待 {wait_time("openai"):.0f} 秒後開始生成。')
         st.subheader("您的選擇：")
         for category, selection in selections.items():
             st.write(f"{category}: {', '.join(selection)}")
         
-        all_selections = json.dumps(selections, ensure_ascii=False)
-        
-        with st.spinner('正在生成歌詞，請稍候...'):
-            st.session_state.lyrics = generate_lyrics(all_selections)
-        
-        st.subheader("生成的歌詞：")
-        st.text_area("歌詞", st.session_state.lyrics, height=300)
+        try:
+            # 相同的選擇直接使用快取結果，勾選重新生成時略過快取
+            draft = None
+            if combined_mode:
+                key = song_cache_key(style, selections)
+                cached = None if regenerate else cache_get(key)
+                start = time.perf_counter()
+                if cached:
+                    draft = tuple(json.loads(cached))
+                else:
+                    with st.spinner('正在生成歌詞和主題，請稍候...'):
+                        draft = singleflight.do(key, lambda: generate_lyrics_and_theme(client, style, selections),
+                                                share=not regenerate)
+                    if draft:
+                        lyrics, changes, issues = ensure_structure(client, style, draft[0])
+                        draft = (lyrics, draft[1])
+                        # 結構仍有問題的歌詞不放進快取，下次重新生成而不是沉默地沿用
+                        if not issues:
+                            cache_put(key, json.dumps(draft, ensure_ascii=False))
+                if draft:
+                    st.session_state.lyrics, st.session_state.theme = draft
+                    st.subheader("生成的歌詞：")
+                    st.text_area("歌詞", st.session_state.lyrics, height=300)
+                    st.caption(f"{'快取命中，' if cached else ''}總耗時: {time.perf_counter() - start:.2f} 秒")
+                    if not cached:
+                        show_structure_report(changes, issues)
+                else:
+                    st.warning('結構化輸出失敗，改用兩次請求生成。')
 
-        with st.spinner('正在生成歌曲主題，請稍候...'):
-            st.session_state.theme = generate_theme(st.session_state.lyrics)
-        
-        st.subheader("生成的歌曲主題：")
-        st.write(st.session_state.theme)
+            if not draft:
+                st.subheader("生成的歌詞：")
+                key = lyrics_cache_key(style, selections)
+                cached = None if regenerate else cache_get(key)
+                if cached:
+                    st.session_state.lyrics = cached
+                    st.text_area("歌詞", st.session_state.lyrics, height=300)
+                    st.caption("快取命中(Cache hit)")
+                elif stream_lyrics:
+                    # 邊生成邊顯示，完成後換成可編輯的文字框
+                    timings = {}
+                    lyrics_placeholder = st.empty()
+                    with lyrics_placeholder.container():
+                        lyrics = st.write_stream(singleflight.stream(
+                            key, lambda: generate_lyrics_stream(client, style, selections, timings), share=not regenerate))
+                    # 串流完成後才能檢查段落結構，文字框顯示修復後的版本
+                    st.session_state.lyrics, changes, issues = ensure_structure(client, style, lyrics)
+                    lyrics_placeholder.text_area("歌詞", st.session_state.lyrics, height=300)
+                    show_structure_report(changes, issues)
+                    if timings:
+                        st.caption(f"首個 token 時間(TTFT): {timings.get('first_token', 0):.2f} 秒，總耗時: {timings.get('total', 0):.2f} 秒")
+                    else:
+                        st.caption("與進行中的相同請求共用結果(Coalesced)")
+                else:
+                    start = time.perf_counter()
+                    with st.spinner('正在生成歌詞，請稍候...'):
+                        lyrics = singleflight.do(key, lambda: generate_lyrics(client, style, selections),
+                                                 share=not regenerate)
+                        st.session_state.lyrics, changes, issues = ensure_structure(client, style, lyrics)
+                    st.text_area("歌詞", st.session_state.lyrics, height=300)
+                    show_structure_report(changes, issues)
+                    st.caption(f"總耗時: {time.perf_counter() - start:.2f} 秒")
+                if not cached and st.session_state.lyrics and not issues:
+                    cache_put(key, st.session_state.lyrics)
+
+                key = theme_cache_key(st.session_state.lyrics)
+                cached = None if regenerate else cache_get(key)
+                if cached:
+                    st.session_state.theme = cached
+                else:
+                    with st.spinner('正在生成歌曲主題，請稍候...'):
+                        lyrics = st.session_state.lyrics
+                        st.session_state.theme = singleflight.do(key, lambda: generate_theme(client, lyrics),
+                                                                 share=not regenerate)
+                    cache_put(key, st.session_state.theme)
+
+            st.subheader("生成的歌曲主題：")
+            st.write(st.session_state.theme)
+        except UpstreamError as e:
+            # 上游逾時或斷路時顯示簡短訊息，不顯示原始例外
+            st.error(str(e))
 
     # 初始化 Suno 客戶端並顯示 credits_info
-    suno_client = initialize_suno_client()
-    #if suno_client:
-    #    try:
-    #        credits_info = suno_client.get_credits()
-    #        st.write(credits_info['credits_left'])
-    #        st.write(credits_info['period'])
-    #        st.write(credits_info['monthly_limit'])
-    #        st.write(credits_info['monthly_usage'])
-    #    except Exception as e:
-    #        st.error(f"取得credits_info 過程: {str(e)}")
-    #        return None
-            
-
-    # 創建可更新的佔位符
-    audio_player = st.empty()
-    video_status = st.empty()
+    suno_ready = initialize_suno_clients(cookies)
+    show_client_stats(stats_before)
+    # 點數由背景執行緒定期更新，這裡只讀取快照，不在每次重跑時呼叫 get_credits
+    for cookie in cookies:
+        start_credit_refresh(cookie)
+    show_account_stats(cookies)
+    credits_info = pool_credits()
+    if credits_info:
+        st.sidebar.write(f"剩餘點數(Credits left): {credits_info['credits_left']}（預留 {credits_info['reserved']}）")
+        st.sidebar.write(f"本期用量: {credits_info['monthly_usage']} / {credits_info['monthly_limit']}")
 
     if st.session_state.lyrics and st.session_state.theme:
         if st.button("生成音樂(Generate Music)"):
-            if not suno_client:
+            if not suno_ready:
                 return
-            with st.spinner('正在生成音樂(Music generating)...'):
-                st.session_state.clip = generate_music(suno_client, st.session_state.lyrics, st.session_state.theme)
-                if not st.session_state.clip:
-                    st.error('音樂生成失敗')
-                    return
-            st.success(f'音樂生成成功! Clip ID: {st.session_state.clip.id}')
-            
-            # 立即顯示音頻播放器
-            audio_player.audio(st.session_state.clip.audio_url, format='audio/mp3')
-            
-            # 開始檢查視頻URL
-            st.session_state.video_url = None
-            video_status.info('影片生成中(Video Generating)，請稍候...')
-            
-            # 使用非阻塞方式檢查視頻URL
-            for _ in range(60):  # 最多等待5分鐘 (60 * 5 秒)
-                video_url = check_video_url(suno_client, st.session_state.clip.id)
-                if video_url:
-                    st.session_state.video_url = video_url
-                    video_status.success(f'影片已生成: {st.session_state.video_url}')
-                    break
-                time.sleep(CHECK_INTERVAL)
-            
-            if not st.session_state.video_url:
-                video_status.warning('影片生成超時，請稍後再試。')
-
-    # 當 video_url 存在時顯示播放按鈕
-    if st.session_state.video_url:
-        if st.button('播放影片(Play video)'):
-            video_html = f"""
-                <video controls width="100%">
-                <source src="{st.session_state.video_url}" type="video/mp4">
-                您的浏览器不支持video标签。
-                </video>
-            """
-            st.markdown(video_html, unsafe_allow_html=True)
+            # 交給背景工作池處理生成與影片輪詢，頁面只保存工作 ID；帳號在放行時由帳號池分配
+            st.session_state.job_id = submit_music_job(
+                None,
+                st.session_state.lyrics,
+                st.session_state.theme,
+                style["suno_tags"],
+                style["max_title_length"],
+                style_id=style_id,
+                selections=selections
+            )
+            st.session_state.job_finished = False
+            st.query_params["job"] = st.session_state.job_id
+
+    if st.session_state.job_id:
+        job = get_job(st.session_state.job_id)
+        if job and job["status"] in FINISHED_STATES:
+            st.session_state.job_finished = True
+        if st.session_state.job_finished:
+            render_music_job(st.session_state.job_id)
+            # 工作結束後顯示各版本的影片播放按鈕
+            job = get_job(st.session_state.job_id)
+            if job:
+                render_video_players(job)
+        elif job and not st.session_state.get("status_push_failed") and status.start_server():
+            music_job_live(job)
+        else:
+            music_job_status()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,297 @@
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+import accounts
+import poller
+import renderer
+import waveform
+import mastering
+import media
+import singleflight
+import history
+from admission import acquire_account, release
+from cache import cache_get, cache_put
+from clients import get_openai_client
+from generation import generate_lyrics, generate_theme, ensure_structure, lyrics_cache_key, theme_cache_key
+from styles import get_style, list_styles, DEFAULT_STYLE
+from jobs import generate_clips
+from jobstore import account_key
+
+# 無介面的批次生成工具：CSV 每一列是一組選擇，依序經過 歌詞 → 主題 → Suno → 影片 四個階段
+#
+#   python batch.py selections.csv --output manifest.jsonl --checkpoint checkpoint.jsonl
+#
+# CSV 的欄位就是風格檔中的類別名稱，每格可用逗號分隔多個選項，可選的 id 欄位作為列的識別碼。
+
+STAGES = ("lyrics", "theme", "suno", "video")
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+def load_secret(name):
+    # 優先使用環境變數，否則讀取 Streamlit 的 secrets.toml
+    if os.environ.get(name):
+        return os.environ[name]
+    with open(SECRETS_PATH, "rb") as f:
+        return tomllib.load(f)[name]
+
+def load_cookies():
+    # 與 app.py 相同：SUNO_COOKIES 設定多個帳號時組成帳號池，否則只用 SUNO_COOKIE
+    try:
+        return accounts.parse_cookies(load_secret("SUNO_COOKIES"))
+    except (KeyError, FileNotFoundError):
+        return [load_secret("SUNO_COOKIE")]
+
+def read_selections(path):
+    rows = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for index, row in enumerate(csv.DictReader(f)):
+            row_id = (row.pop("id", None) or "").strip() or str(index)
+            selections = {}
+            for category, value in row.items():
+                value = (value or "").replace("，", ",")
+                selections[category] = [option.strip() for option in value.split(",") if option.strip()]
+            rows.append((row_id, selections))
+    return rows
+
+def load_checkpoint(path):
+    # checkpoint 每行是某一列的最新狀態，後寫入的覆蓋先寫入的
+    states = {}
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    state = json.loads(line)
+                    states[state["row_id"]] = state
+    return states
+
+def next_stage(state):
+    if state.get("status") == "done":
+        return None
+    if not state.get("lyrics"):
+        return "lyrics"
+    if not state.get("theme"):
+        return "theme"
+    if not state.get("clips"):
+        return "suno"
+    return "video"
+
+class BatchPipeline:
+    def __init__(self, rows, states, checkpoint_path, concurrency, style, regenerate=False):
+        self.rows = dict(rows)
+        self.style = style
+        self.states = states
+        self.checkpoint_path = checkpoint_path
+        self.regenerate = regenerate
+        self.client = get_openai_client(load_secret("OPENAI_API_KEY"))
+        self.cookies = {account_key(cookie): cookie for cookie in accounts.configure(load_cookies())}
+        self.executors = {
+            stage: ThreadPoolExecutor(max_workers=concurrency[stage], thread_name_prefix=f"batch-{stage}")
+            for stage in STAGES
+        }
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.finished = threading.Event()
+        self.stage_stats = {stage: {"count": 0, "errors": 0, "seconds": 0.0} for stage in STAGES}
+
+    def _save(self, state):
+        with self.lock:
+            self.states[state["row_id"]] = state
+            if self.checkpoint_path:
+                with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(state, ensure_ascii=False) + "\n")
+
+    def _advance(self, row_id):
+        stage = next_stage(self.states[row_id])
+        if stage is None or self.states[row_id].get("status") == "failed":
+            with self.lock:
+                self.remaining -= 1
+                if self.remaining == 0:
+                    self.finished.set()
+            return
+        self.executors[stage].submit(self._run_stage, stage, row_id)
+
+    def _run_stage(self, stage, row_id):
+        state = dict(self.states[row_id])
+        start = time.perf_counter()
+        try:
+            getattr(self, f"_stage_{stage}")(state)
+        except Exception as e:
+            state["status"] = "failed"
+            state["error"] = f"{stage}: {str(e)}"
+        with self.lock:
+            stats = self.stage_stats[stage]
+            stats["count"] += 1
+            stats["errors"] += 1 if state.get("status") == "failed" else 0
+            stats["seconds"] += time.perf_counter() - start
+        state["updated_at"] = time.time()
+        self._save(state)
+        self._advance(row_id)
+
+    def _stage_lyrics(self, state):
+        selections = self.rows[state["row_id"]]
+        key = lyrics_cache_key(self.style, selections)
+        lyrics = None if self.regenerate else cache_get(key)
+        if not lyrics:
+            # 相同選擇的列同時執行時只送出一次請求
+            lyrics = singleflight.do(
+                key, lambda: generate_lyrics(self.client, self.style, selections),
+                share=not self.regenerate
+            )
+            # 段落標記有誤時先在本地修復，快取中只存修復後的版本
+            lyrics, _, issues = ensure_structure(self.client, self.style, lyrics)
+            if issues:
+                raise ValueError(f"歌詞結構無法修正: {'; '.join(issues)}")
+            cache_put(key, lyrics)
+        state["lyrics"] = lyrics
+
+    def _stage_theme(self, state):
+        key = theme_cache_key(state["lyrics"])
+        theme = None if self.regenerate else cache_get(key)
+        if not theme:
+            theme = singleflight.do(key, lambda: generate_theme(self.client, state["lyrics"]), share=not self.regenerate)
+            cache_put(key, theme)
+        state["theme"] = theme
+
+    def _cookie(self, state):
+        # clip 屬於生成它的帳號；舊的 checkpoint 沒有記錄帳號時使用第一個帳號
+        return self.cookies.get(state.get("account")) or next(iter(self.cookies.values()))
+
+    def _stage_suno(self, state):
+        # 分配到進行中最少且點數足夠的帳號
+        cookie = acquire_account()
+        try:
+            clips = generate_clips(cookie, state["lyrics"], state["theme"],
+                                  self.style["suno_tags"], self.style["max_title_length"])
+        finally:
+            release(cookie)
+        state["account"] = account_key(cookie)
+        clips = [clip for clip in clips or [] if clip.audio_url]
+        if not clips:
+            raise Exception("音樂生成失敗")
+        # 保留同一次 generate 產生的所有版本
+        state["clips"] = [{"id": clip.id, "audio_url": clip.audio_url, "video_url": None} for clip in clips]
+
+    def _stage_video(self, state):
+        # 影片查詢交給共用輪詢器批次處理，這裡只等待結果
+        clips = [clip for clip in state["clips"] if not clip.get("video_url")]
+        done = threading.Semaphore(0)
+        results = {}
+
+        def on_video(clip_id, video_url, checks):
+            results[clip_id] = video_url
+            done.release()
+
+        cookie = self._cookie(state)
+        for clip in clips:
+            poller.watch(cookie, clip["id"], on_video)
+        renders = {}
+        for clip in clips:
+            # 本地繪製的影片與 Suno 的影片同時進行；manifest 記錄 Suno 的網址與本地檔案路徑，不記錄本機伺服器網址
+            audio_path = media.fetch(clip["id"], clip["audio_url"], "mp3")
+            if not audio_path:
+                continue
+            audio_path = mastering.master_clip(clip["id"], audio_path)
+            waveform.ensure_peaks(clip["id"], mastering.served_ext(clip["id"]))
+            renders[clip["id"]] = renderer.render_clip(clip["id"], audio_path, state["lyrics"],
+                                                       state["theme"][:self.style["max_title_length"]])
+        for _ in clips:
+            done.acquire()
+        local_videos = {}
+        for clip_id, future in renders.items():
+            try:
+                if future:
+                    future.result()
+            except Exception:
+                continue
+            if media.is_cached(clip_id, "mp4"):
+                local_videos[clip_id] = media.media_path(clip_id, "mp4")
+        state["clips"] = [
+            {**clip, "video_url": clip.get("video_url") or results.get(clip["id"]),
+             "local_video": clip.get("local_video") or local_videos.get(clip["id"])}
+            for clip in state["clips"]
+        ]
+        if not any(clip["video_url"] or clip["local_video"] for clip in state["clips"]):
+            raise Exception("影片生成超時")
+        state["status"] = "done"
+        # 以第一個 clip 作為歌曲代號，同一列續跑時不會重複寫入歌曲庫
+        history.record(f'batch-{state["clips"][0]["id"]}', self.style["id"], state["theme"], state["lyrics"],
+                       self.rows[state["row_id"]], self.style["suno_tags"], state["clips"], "done", time.time())
+
+    def run(self):
+        start = time.perf_counter()
+        pending = []
+        for row_id in self.rows:
+            state = self.states.get(row_id, {"row_id": row_id})
+            # 上次失敗的列從失敗的階段重新開始
+            state.pop("error", None)
+            if state.get("status") == "failed":
+                state["status"] = "pending"
+            self.states[row_id] = state
+            if next_stage(state):
+                pending.append(row_id)
+        self.remaining = len(pending)
+        if pending:
+            for row_id in pending:
+                self._advance(row_id)
+            self.finished.wait()
+        for executor in self.executors.values():
+            executor.shutdown()
+        return time.perf_counter() - start
+
+def write_manifest(path, rows, states):
+    with open(path, "w", encoding="utf-8") as f:
+        for row_id, _ in rows:
+            state = states.get(row_id, {"row_id": row_id})
+            f.write(json.dumps({
+                "row_id": row_id,
+                "status": state.get("status"),
+                "theme": state.get("theme"),
+                "clips": state.get("clips", []),
+                "error": state.get("error"),
+            }, ensure_ascii=False) + "\n")
+
+def print_stats(elapsed, rows, states, stage_stats):
+    done = sum(1 for row_id, _ in rows if states.get(row_id, {}).get("status") == "done")
+    failed = sum(1 for row_id, _ in rows if states.get(row_id, {}).get("status") == "failed")
+    print(f"完成 {done} 首，失敗 {failed} 首，共 {len(rows)} 列，耗時 {elapsed:.1f} 秒")
+    if elapsed > 0:
+        print(f"吞吐量: {done / elapsed * 60:.2f} 首/分鐘")
+    for stage in STAGES:
+        stats = stage_stats[stage]
+        average = stats["seconds"] / stats["count"] if stats["count"] else 0.0
+        print(f"  {stage:<6} 執行 {stats['count']} 次，錯誤 {stats['errors']} 次，平均 {average:.2f} 秒")
+    stats = singleflight.singleflight_stats()
+    print(f"合併的重複請求: {stats['collapsed']} 次（實際送出 {stats['leaders']} 次）")
+
+def main():
+    parser = argparse.ArgumentParser(description="批次生成歌曲(Batch song generator)")
+    parser.add_argument("input", help="選擇內容的 CSV 檔")
+    parser.add_argument("--output", default="manifest.jsonl", help="輸出的 manifest 檔")
+    parser.add_argument("--checkpoint", default="checkpoint.jsonl", help="可續跑的 checkpoint 檔")
+    parser.add_argument("--lyrics-concurrency", type=int, default=8)
+    parser.add_argument("--theme-concurrency", type=int, default=8)
+    parser.add_argument("--suno-concurrency", type=int, default=2)
+    parser.add_argument("--video-concurrency", type=int, default=20)
+    parser.add_argument("--style", default=DEFAULT_STYLE, choices=list(list_styles()), help="歌曲風格")
+    parser.add_argument("--regenerate", action="store_true", help="不使用歌詞與主題快取")
+    args = parser.parse_args()
+
+    rows = read_selections(args.input)
+    states = load_checkpoint(args.checkpoint)
+    concurrency = {
+        "lyrics": args.lyrics_concurrency,
+        "theme": args.theme_concurrency,
+        "suno": args.suno_concurrency,
+        "video": args.video_concurrency,
+    }
+    pipeline = BatchPipeline(rows, states, args.checkpoint, concurrency, get_style(args.style), args.regenerate)
+    elapsed = pipeline.run()
+    write_manifest(args.output, rows, pipeline.states)
+    print_stats(elapsed, rows, pipeline.states, pipeline.stage_stats)
+
+if __name__ == "__main__":
+    main()
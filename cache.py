@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Constants
+CACHE_PATH = os.path.join(".cache", "generation_cache.sqlite3")
+CACHE_TTL = 7 * 24 * 60 * 60  # 快取保存 7 天
+CACHE_MAX_ENTRIES = 2000  # 超過此數量時依最近使用時間淘汰
+
+_lock = threading.Lock()
+_conn = None
+_stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+def _connection():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        _conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+    return _conn
+
+def canonical_selections(selections):
+    # 去除空白、重複與順序差異，讓相同的選擇對應到同一個 key；沒有選擇的類別不會出現在提示詞中，也不放進 key
+    canonical = {}
+    for category, selected in selections.items():
+        options = sorted({option.strip() for option in selected if option and option.strip()})
+        if options:
+            canonical[category.strip()] = options
+    return canonical
+
+def make_key(kind, **parts):
+    payload = json.dumps({"kind": kind, **parts}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def cache_get(key):
+    now = time.time()
+    with _lock:
+        conn = _connection()
+        row = conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row and now - row[1] < CACHE_TTL:
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            _stats["hits"] += 1
+            return row[0]
+        if row:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            conn.commit()
+        _stats["misses"] += 1
+        return None
+
+def cache_put(key, value):
+    now = time.time()
+    with _lock:
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, value, now, now)
+        )
+        _stats["writes"] += 1
+        _evict(conn, now)
+        conn.commit()
+
+def _evict(conn, now):
+    expired = conn.execute("DELETE FROM cache WHERE created_at < ?", (now - CACHE_TTL,)).rowcount
+    count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+    overflow = max(0, count - CACHE_MAX_ENTRIES)
+    if overflow:
+        conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+            (overflow,)
+        )
+    _stats["evictions"] += expired + overflow
+
+def cache_stats():
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
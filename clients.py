@@ -0,0 +1,93 @@
+import threading
+import time
+from openai import OpenAI
+from suno import Suno, ModelVersions
+import transport
+
+# Constants
+HEALTH_CHECK_INTERVAL = 300  # 健康檢查間隔秒數
+
+# 每個憑證在整個進程中只保留一個客戶端，Streamlit 重跑腳本時直接重用
+_lock = threading.Lock()
+_suno_clients = {}
+_suno_locks = {}  # cookie -> 該憑證建立與檢查客戶端時的鎖
+_openai_clients = {}
+
+# 統計數據：客戶端建立次數與握手耗時
+_stats = {
+    "suno_constructions": 0,
+    "suno_handshake_seconds": 0.0,
+    "suno_reuses": 0,
+    "suno_health_checks": 0,
+    "suno_rebuilds": 0,
+    "openai_constructions": 0,
+    "openai_reuses": 0,
+}
+
+def _build_suno_client(cookie):
+    start = time.perf_counter()
+    suno_client = Suno(cookie=cookie, model_version=ModelVersions.CHIRP_V3_5)
+    # 建立後改用共用連線池，之後的請求與重建的客戶端都能重用已建立的連線
+    transport.mount(suno_client.client)
+    with _lock:
+        _stats["suno_constructions"] += 1
+        _stats["suno_handshake_seconds"] += time.perf_counter() - start
+    return {"client": suno_client, "checked_at": time.time()}
+
+def _is_healthy(entry):
+    # 只在超過檢查間隔時才向 Suno 確認 session 是否仍然有效
+    if time.time() - entry["checked_at"] < HEALTH_CHECK_INTERVAL:
+        return True
+    with _lock:
+        _stats["suno_health_checks"] += 1
+    try:
+        entry["client"].get_credits()
+        entry["checked_at"] = time.time()
+        return True
+    except Exception:
+        return False
+
+def get_suno_client(cookie):
+    # 健康檢查與建立客戶端都要連線 Suno，只持有該憑證的鎖；
+    # 一個緩慢或過期的憑證不會擋住其他憑證與其他 session
+    with _lock:
+        cookie_lock = _suno_locks.setdefault(cookie, threading.Lock())
+    with cookie_lock:
+        with _lock:
+            entry = _suno_clients.get(cookie)
+        if entry and _is_healthy(entry):
+            with _lock:
+                _stats["suno_reuses"] += 1
+            return entry["client"]
+        if entry:
+            with _lock:
+                _stats["suno_rebuilds"] += 1
+        entry = _build_suno_client(cookie)
+        with _lock:
+            _suno_clients[cookie] = entry
+        return entry["client"]
+
+def invalidate_suno_client(cookie):
+    # 呼叫端發現 session 過期時呼叫，下次取用時重建
+    with _lock:
+        _suno_clients.pop(cookie, None)
+
+def get_openai_client(api_key):
+    with _lock:
+        openai_client = _openai_clients.get(api_key)
+        if openai_client:
+            _stats["openai_reuses"] += 1
+            return openai_client
+        openai_client = OpenAI(api_key=api_key, http_client=transport.http_client())
+        _openai_clients[api_key] = openai_client
+        _stats["openai_constructions"] += 1
+        return openai_client
+
+def client_stats():
+    with _lock:
+        stats = dict(_stats)
+    constructions = stats["suno_constructions"]
+    stats["suno_avg_handshake_seconds"] = (
+        stats["suno_handshake_seconds"] / constructions if constructions else 0.0
+    )
+    return stats
@@ -0,0 +1,267 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from generation import count_tokens, message_tokens, MESSAGE_OVERHEAD_TOKENS
+
+# 壓力測試用的本地替身伺服器，模擬 OpenAI chat completions 與 suno 套件用到的 Suno 端點，
+# 不會花到真正的點數。延遲以對數常態分布模擬，並可設定失敗率與音檔、影片完成所需時間。
+
+FAKE_LYRICS = """[intro]
+[Verse1]
+夕陽照著老庭院 你我牽手走過從前
+[Chorus]
+一生的愛 慢慢地說 溫暖在心頭
+[Verse2]
+老照片裡的笑臉 還是當年的模樣
+[Chorus]
+一生的愛 慢慢地說 溫暖在心頭
+[Bride]
+歲月輕輕 走過 留下我們的歌
+[Chorus]
+一生的愛 慢慢地說 溫暖在心頭
+[Outro]
+夕陽下 我們的歌
+[End]"""
+FAKE_THEME = "夕陽下的老歌"
+CACHE_MIN_TOKENS = 1024  # 與 OpenAI 相同：前綴至少 1024 個 token 才會快取，之後以 128 個 token 為單位
+CACHE_INCREMENT = 128
+
+class LatencyModel:
+    def __init__(self, median=0.5, sigma=0.5, failure_rate=0.0):
+        self.median = median
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+
+    def sleep(self):
+        if self.median > 0:
+            time.sleep(self.median * random.lognormvariate(0, self.sigma))
+
+    def should_fail(self):
+        return random.random() < self.failure_rate
+
+class FakeServer:
+    def __init__(self, handler_class, **settings):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.settings = settings
+        server = self
+
+        class Handler(handler_class):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+class JSONHandler(BaseHTTPRequestHandler):
+    # 與真正的上游一樣保持連線，才能觀察連線池的重用情況
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+class OpenAIHandler(JSONHandler):
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = self._read_json()
+        self.fake.count("chat.completions")
+        latency = self.fake.settings["latency"]
+        latency.sleep()
+        if latency.should_fail():
+            self._send_json(500, {"error": {"message": "fake upstream failure", "type": "server_error"}})
+            return
+        content = self._content(request)
+        usage = self._usage(request, content)
+        if request.get("stream"):
+            self._send_stream(request, content, usage)
+        else:
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                             "message": {"role": "assistant", "content": content, "refusal": None}}],
+                "usage": usage,
+            })
+
+    def _usage(self, request, content):
+        # 模擬上游的提示詞快取：第一則訊息與之前的請求完全相同時，前綴的 token 算成命中快取
+        messages = request["messages"]
+        prompt_tokens = message_tokens(messages)
+        prefix = messages[0]["content"]
+        prefix_tokens = count_tokens(prefix) + MESSAGE_OVERHEAD_TOKENS
+        with self.fake.lock:
+            seen = prefix in self.fake.prefixes
+            self.fake.prefixes.add(prefix)
+        cached = prefix_tokens // CACHE_INCREMENT * CACHE_INCREMENT if seen and prefix_tokens >= CACHE_MIN_TOKENS else 0
+        completion_tokens = count_tokens(content)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    def _content(self, request):
+        if (request.get("response_format") or {}).get("type") == "json_schema":
+            return json.dumps({"lyrics": FAKE_LYRICS, "title": FAKE_THEME}, ensure_ascii=False)
+        system_prompt = request["messages"][0]["content"]
+        return FAKE_THEME if "theme" in system_prompt else FAKE_LYRICS
+
+    def _send_stream(self, request, content, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        token_delay = self.fake.settings.get("token_delay", 0.01)
+        for index in range(0, len(content), 4):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{"index": 0, "delta": {"content": content[index:index + 4]}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(token_delay)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.get("model", "fake"), "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+class SunoHandler(JSONHandler):
+    def _clip(self, clip_id):
+        clip = self.fake.clips[clip_id]
+        age = time.time() - clip["created"]
+        audio_ready = age >= self.fake.settings["audio_delay"]
+        video_ready = age >= self.fake.settings["video_delay"]
+        return {
+            "id": clip_id,
+            "video_url": f"{self.fake.url}/media/{clip_id}.mp4" if video_ready else "",
+            "audio_url": f"{self.fake.url}/media/{clip_id}.mp3" if audio_ready else "",
+            "image_url": None,
+            "image_large_url": None,
+            "is_video_pending": not video_ready,
+            "major_model_version": "v3",
+            "model_name": "chirp-v3",
+            "metadata": {"tags": clip["tags"], "prompt": clip["prompt"], "duration": 120.0},
+            "is_liked": False,
+            "user_id": "fake-user",
+            "display_name": "fake",
+            "handle": "fake",
+            "is_handle_updated": False,
+            "is_trashed": False,
+            "reaction": None,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(clip["created"])),
+            "status": "complete" if audio_ready else "submitted",
+            "title": clip["title"],
+            "play_count": 0,
+            "upvote_count": 0,
+            "is_public": False,
+        }
+
+    def _upstream(self, endpoint):
+        self.fake.count(endpoint)
+        latency = self.fake.settings["latency"]
+        latency.sleep()
+        if latency.should_fail():
+            self._send_json(500, {"detail": "fake upstream failure"})
+            return False
+        return True
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/v1/client":
+            self.fake.count("clerk.client")
+            self._send_json(200, {"response": {"last_active_session_id": "fake-session"}})
+        elif parsed.path == "/api/feed/":
+            if self._upstream("get_songs"):
+                ids = parse_qs(parsed.query).get("ids", [""])[0].split(",")
+                self._send_json(200, [self._clip(clip_id) for clip_id in ids if clip_id in self.fake.clips])
+        elif parsed.path.startswith("/media/"):
+            # 模擬 CDN 上的音檔與影片
+            self.fake.count("cdn")
+            media_file = self.fake.settings.get("media_file")
+            if media_file and parsed.path.endswith(".mp3"):
+                with open(media_file, "rb") as f:
+                    body = f.read()
+            else:
+                body = b"\0" * self.fake.settings["media_bytes"]
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg" if parsed.path.endswith(".mp3") else "video/mp4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif parsed.path == "/api/billing/info/":
+            if self._upstream("get_credits"):
+                self._send_json(200, {"total_credits_left": self.fake.settings["credits"], "period": None,
+                                      "monthly_limit": 2500, "monthly_usage": 0})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path.startswith("/v1/client/sessions/"):
+            self.fake.count("clerk.token")
+            self._read_json()
+            self._send_json(200, {"jwt": f"fake-jwt-{uuid.uuid4().hex}"})
+        elif parsed.path == "/api/generate/v2/":
+            request = self._read_json()
+            if not self._upstream("generate"):
+                return
+            now = time.time()
+            clip_ids = [str(uuid.uuid4()) for _ in range(2)]
+            with self.fake.lock:
+                for clip_id in clip_ids:
+                    self.fake.clips[clip_id] = {"created": now, "title": request.get("title", ""),
+                                                "tags": request.get("tags", ""), "prompt": request.get("prompt", "")}
+            self._send_json(200, {"clips": [self._clip(clip_id) for clip_id in clip_ids]})
+        else:
+            self.send_error(404)
+
+def start_fake_openai(latency=None, token_delay=0.01):
+    server = FakeServer(OpenAIHandler, latency=latency or LatencyModel(), token_delay=token_delay)
+    server.prefixes = set()
+    return server.start()
+
+def start_fake_suno(latency=None, audio_delay=5, video_delay=30, credits=100000, media_bytes=256 * 1024,
+                    media_file=None):
+    # media_file 指定真正的 mp3 時，音檔網址回傳該檔案，可用來測試本地影片繪製
+    server = FakeServer(SunoHandler, latency=latency or LatencyModel(0.2), audio_delay=audio_delay,
+                        video_delay=video_delay, credits=credits, media_bytes=media_bytes, media_file=media_file)
+    server.clips = {}
+    return server.start()
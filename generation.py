@@ -0,0 +1,263 @@
+import re
+import threading
+import time
+from pydantic import BaseModel
+import resilience
+import structure
+from admission import acquire
+from metrics import timed, timed_stream, inc, describe
+from cache import canonical_selections, make_key
+
+try:
+    import tiktoken  # 安裝 tiktoken 時用模型實際的分詞器計算 token 數
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except ImportError:
+    _ENCODING = None
+
+# Constants
+OPENAI_MODEL = "gpt-4o-mini"
+SELECTIONS_REFERENCE = "使用者列出的元素"  # 風格檔中的 {all_selections} 換成這段文字，選擇改放在使用者訊息
+EMPTY_SELECTIONS = "（未指定，請自由發揮）"
+MESSAGE_OVERHEAD_TOKENS = 3  # 每則訊息的角色與分隔符號
+
+LYRICS_SYSTEM_PROMPT = "You are a professional Taiwanese song lyricist."
+THEME_SYSTEM_PROMPT = "You are a professional song theme creator."
+
+_CJK_RE = re.compile(r"[\u3000-\u9fff\uf900-\ufaff\uff00-\uffef]")
+_CATEGORY_SUFFIX_RE = re.compile(r"\s*\([^)]*\)\s*$")
+
+_lock = threading.Lock()
+_stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "estimated_tokens": 0, "prefix_tokens": 0}
+
+def count_tokens(text):
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    # 沒有 tiktoken 時粗估：中文字大約一字一個 token，其他字元約四個一個 token
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def message_tokens(messages):
+    return sum(count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages) + MESSAGE_OVERHEAD_TOKENS
+
+def _record_usage(stage, messages, usage):
+    # usage 為上游回報的實際用量；cached_tokens 是命中上游提示詞快取的前綴長度
+    estimated = message_tokens(messages)
+    # 第一則訊息是每個風格固定的前綴，可以被上游快取的部分
+    prefix = count_tokens(messages[0]["content"]) + MESSAGE_OVERHEAD_TOKENS
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or estimated
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    with _lock:
+        _stats["requests"] += 1
+        _stats["prompt_tokens"] += prompt_tokens
+        _stats["cached_tokens"] += cached_tokens
+        _stats["estimated_tokens"] += estimated
+        _stats["prefix_tokens"] += prefix
+    inc("song_prompt_tokens_total", {"stage": stage}, prompt_tokens)
+    inc("song_prompt_cached_tokens_total", {"stage": stage}, cached_tokens)
+
+def prompt_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["avg_prompt_tokens"] = stats["prompt_tokens"] / stats["requests"] if stats["requests"] else 0.0
+    stats["cached_ratio"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+    stats["prefix_ratio"] = stats["prefix_tokens"] / stats["estimated_tokens"] if stats["estimated_tokens"] else 0.0
+    stats["tokenizer"] = "tiktoken" if _ENCODING is not None else "estimate"
+    return stats
+
+def compact_selections(selections):
+    # 每個類別一行，略過沒有選擇的類別；類別名稱後的英文說明對模型沒有幫助
+    lines = []
+    for category, selected in selections.items():
+        options = [option.strip() for option in selected if option and option.strip()]
+        if options:
+            lines.append(f"{_CATEGORY_SUFFIX_RE.sub('', category)}：{'、'.join(options)}")
+    return "\n".join(lines) or EMPTY_SELECTIONS
+
+def build_lyrics_prefix(style):
+    # 每個風格固定不變的指示放在最前面的 system 訊息，讓上游可以快取這段前綴；
+    # 每次請求不同的選擇放在後面的使用者訊息。歌詞提示詞模板來自風格檔，例如國語與台語只差在這裡
+    instructions = style["lyrics_prompt"].format(all_selections=SELECTIONS_REFERENCE)
+    lines = [line.strip() for line in instructions.splitlines() if line.strip()]
+    return "\n".join([LYRICS_SYSTEM_PROMPT, *lines])
+
+def lyrics_messages(style, selections):
+    return [
+        {"role": "system", "content": build_lyrics_prefix(style)},
+        {"role": "user", "content": compact_selections(selections)}
+    ]
+
+@timed("lyrics")
+def generate_lyrics(client, style, selections):
+    messages = lyrics_messages(style, selections)
+    acquire("openai")
+    response = resilience.call("openai", "lyrics", lambda timeout: client.with_options(
+        timeout=timeout, max_retries=0
+    ).chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages
+    ))
+    _record_usage("lyrics", messages, response.usage)
+    return response.choices[0].message.content
+
+@timed_stream("lyrics")
+def generate_lyrics_stream(client, style, selections, timings):
+    # 逐段產生歌詞，並在 timings 中記錄首個 token 時間與總耗時
+    messages = lyrics_messages(style, selections)
+    acquire("openai")
+    start = time.perf_counter()
+    # 串流的逾時是兩個片段之間最久的等待時間
+    stream = resilience.call_stream("openai", "lyrics", lambda timeout: client.with_options(
+        timeout=timeout, max_retries=0
+    ).chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}
+    ))
+    usage = None
+    for chunk in stream:
+        # 用量在最後一個沒有 choices 的片段中
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if content:
+            if "first_token" not in timings:
+                timings["first_token"] = time.perf_counter() - start
+            yield content
+    _record_usage("lyrics", messages, usage)
+    timings["total"] = time.perf_counter() - start
+
+def build_theme_prefix():
+    return f"{THEME_SYSTEM_PROMPT}\n根據使用者提供的歌詞，給出一個適合的歌曲主題。請提供一個簡潔而富有意境的主題。"
+
+def theme_messages(lyrics):
+    return [
+        {"role": "system", "content": build_theme_prefix()},
+        {"role": "user", "content": lyrics}
+    ]
+
+@timed("theme")
+def generate_theme(client, lyrics):
+    messages = theme_messages(lyrics)
+    acquire("openai")
+    response = resilience.call("openai", "theme", lambda timeout: client.with_options(
+        timeout=timeout, max_retries=0
+    ).chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages
+    ))
+    _record_usage("theme", messages, response.usage)
+    return response.choices[0].message.content
+
+def build_fix_prompt(style, lyrics, issues):
+    # 只要求修正結構問題，其餘歌詞盡量不動，比重新生成便宜也較不會改掉使用者看過的內容
+    sections = "-".join(f"[{name}]" for name in style.get("structure", structure.DEFAULT_STRUCTURE))
+    problems = "\n".join(f"- {issue}" for issue in issues)
+    return f"""以下歌詞的段落結構有問題：
+{problems}
+詞曲的結構必須是{sections}，最前面是 {style.get("intro_marker", "[intro]")}，最後面是{structure.END_MARKER}。
+請只修正上述問題，其餘歌詞保持不變，每段不超過{structure.MAX_SECTION_LINES}行，只輸出完整的歌詞：
+{lyrics}"""
+
+@timed("lyrics_fix")
+def fix_lyrics_structure(client, style, lyrics, issues):
+    messages = [
+        {"role": "system", "content": LYRICS_SYSTEM_PROMPT},
+        {"role": "user", "content": build_fix_prompt(style, lyrics, issues)}
+    ]
+    acquire("openai")
+    response = resilience.call("openai", "lyrics_fix", lambda timeout: client.with_options(
+        timeout=timeout, max_retries=0
+    ).chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages
+    ))
+    _record_usage("lyrics_fix", messages, response.usage)
+    return response.choices[0].message.content
+
+def ensure_structure(client, style, lyrics):
+    # 先在本地修復段落標記，只有缺段落或段落過長這類本地無法處理的問題才請模型修正；
+    # 回傳 (歌詞, 修改紀錄, 仍未解決的問題)
+    text, report = structure.repair(lyrics, style)
+    if not report["issues"]:
+        return text, report["changes"], []
+    try:
+        fixed = fix_lyrics_structure(client, style, text, report["issues"])
+    except resilience.UpstreamError:
+        fixed = None
+    if not fixed:
+        structure.record_llm_failure()
+        return text, report["changes"], report["issues"]
+    fixed_text, fixed_report = structure.repair(fixed, style, after_llm=True)
+    if fixed_report["issues"]:
+        # 模型修正後仍有問題時保留原本的歌詞，避免換成更差的版本
+        return text, report["changes"], report["issues"]
+    return fixed_text, report["changes"] + ["模型修正段落結構"] + fixed_report["changes"], []
+
+class SongDraft(BaseModel):
+    lyrics: str
+    title: str
+
+def build_song_prefix(style):
+    return build_lyrics_prefix(style) + f"""
+另外請根據歌詞給出一個簡潔而富有意境的歌曲主題作為 title，不超過{style["max_title_length"]}個字符。"""
+
+def song_messages(style, selections):
+    return [
+        {"role": "system", "content": build_song_prefix(style)},
+        {"role": "user", "content": compact_selections(selections)}
+    ]
+
+@timed("lyrics_and_theme")
+def generate_lyrics_and_theme(client, style, selections):
+    # 一次請求同時取得歌詞與主題，省下第二次請求與重複送出的歌詞
+    messages = song_messages(style, selections)
+    acquire("openai")
+    try:
+        response = resilience.call("openai", "lyrics_and_theme", lambda timeout: client.with_options(
+            timeout=timeout, max_retries=0
+        ).beta.chat.completions.parse(
+            model=OPENAI_MODEL,
+            messages=messages,
+            response_format=SongDraft
+        ))
+        _record_usage("lyrics_and_theme", messages, response.usage)
+        draft = response.choices[0].message.parsed
+    except Exception:
+        inc("song_stage_errors_total", {"stage": "lyrics_and_theme"})
+        draft = None
+    if not draft or not draft.lyrics.strip() or not draft.title.strip():
+        return None
+    return draft.lyrics, draft.title.strip()[:style["max_title_length"]]
+
+def lyrics_cache_key(style, selections):
+    return make_key(
+        "lyrics",
+        selections=canonical_selections(selections),
+        template=build_lyrics_prefix(style),
+        model=OPENAI_MODEL,
+        style=style["suno_tags"]
+    )
+
+def song_cache_key(style, selections):
+    return make_key(
+        "song",
+        selections=canonical_selections(selections),
+        template=build_song_prefix(style),
+        model=OPENAI_MODEL,
+        style=style["suno_tags"]
+    )
+
+def theme_cache_key(lyrics):
+    return make_key(
+        "theme",
+        lyrics=lyrics.strip(),
+        template=build_theme_prefix(),
+        model=OPENAI_MODEL
+    )
+
+describe("song_prompt_tokens_total", "counter", "Input tokens sent to OpenAI per stage, as reported in usage.")
+describe("song_prompt_cached_tokens_total", "counter", "Input tokens served from the upstream prompt cache per stage.")
@@ -0,0 +1,218 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import metrics
+import jobstore
+from jobs import DONE, TIMEOUT
+
+# 歌曲庫：每首完成的歌曲連同歌詞、主題、各類別的選擇與 clip 資訊寫入 SQLite，
+# 以 FTS5 全文檢索，讓使用者找回之前生成的歌曲，不必重新生成。
+# unicode61 分詞器會把整段中文當成一個詞，這裡在寫入與查詢前自行把中文切成重疊的雙字詞。
+
+# Constants
+HISTORY_PATH = os.path.join("data", "history.sqlite3")
+PAGE_SIZE = 12
+RECORDED_STATES = (DONE, TIMEOUT)  # 超時的歌曲仍有音檔，一樣保留
+
+_CJK_RUN_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+
+_lock = threading.Lock()
+_conn = None
+_backfilled = False
+_stats = {"recorded": 0, "searches": 0, "pages": 0, "query_seconds": 0.0}
+
+def _connection():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(HISTORY_PATH), exist_ok=True)
+        _conn = sqlite3.connect(HISTORY_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute(
+            """CREATE TABLE IF NOT EXISTS songs (
+                id INTEGER PRIMARY KEY,
+                song_id TEXT NOT NULL UNIQUE,
+                style TEXT,
+                theme TEXT NOT NULL,
+                lyrics TEXT NOT NULL,
+                selections TEXT NOT NULL,
+                tags TEXT,
+                clips TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        # id 依寫入順序遞增，分頁直接用主鍵；篩選風格時用 (style, id) 索引
+        _conn.execute("CREATE INDEX IF NOT EXISTS songs_style ON songs (style, id)")
+        _conn.execute(
+            """CREATE TABLE IF NOT EXISTS song_options (
+                category TEXT NOT NULL,
+                option TEXT NOT NULL,
+                song INTEGER NOT NULL,
+                PRIMARY KEY (category, option, song)
+            ) WITHOUT ROWID"""
+        )
+        _conn.execute("CREATE TABLE IF NOT EXISTS history_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # 內容只存在 songs，索引表不重複保存原文；之後只更新不在索引中的 clip 資訊，不需要刪除
+        _conn.execute(
+            """CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5 (
+                theme, lyrics, selections, meta, content='', tokenize='unicode61'
+            )"""
+        )
+    return _conn
+
+def segment(text):
+    # 「櫻花樹下」→「櫻花 花樹 樹下 下」；最後的單字讓查詢結尾落在詞尾時也能比對
+    def bigrams(match):
+        run = match.group(0)
+        if len(run) == 1:
+            return f" {run} "
+        return " " + " ".join([*(run[i:i + 2] for i in range(len(run) - 1)), run[-1]]) + " "
+    return _CJK_RUN_RE.sub(bigrams, text or "")
+
+def match_query(text):
+    # 每個以空白分隔的詞都要出現。兩個字以上的中文以相鄰的雙字詞比對，不需要前綴展開；
+    # 單一中文字與英文（例如 clip ID 的開頭）用前綴比對
+    terms = []
+    for term in text.split():
+        tokens = segment(term).split()
+        if not tokens:
+            continue
+        if len(tokens) > 1 and _CJK_RUN_RE.fullmatch(tokens[-1]):
+            tokens.pop()  # 詞尾的單字已經包含在最後一個雙字詞中
+        phrase = " ".join(tokens).replace('"', '""')
+        prefix = "" if _CJK_RUN_RE.fullmatch(tokens[-1]) and len(tokens[-1]) > 1 else "*"
+        terms.append(f'"{phrase}"{prefix}')
+    return " AND ".join(terms)
+
+def _selections_text(selections):
+    return "\n".join(f"{category}: {' '.join(options)}" for category, options in selections.items() if options)
+
+def _insert(conn, song_id, style, theme, lyrics, selections, tags, clips, status, created_at):
+    # 同一首歌重複寫入時忽略，工作重啟時不會產生重複的紀錄；回傳是否寫入
+    clips = [{"id": clip["id"], "audio_url": clip.get("audio_url"), "video_url": clip.get("video_url"),
+              "status": clip.get("status"), "local_video": bool(clip.get("local_video"))} for clip in clips]
+    meta = " ".join([style or "", tags or "", *(clip["id"] for clip in clips)])
+    cursor = conn.execute(
+        """INSERT OR IGNORE INTO songs (song_id, style, theme, lyrics, selections, tags, clips, status, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (song_id, style, theme, lyrics, json.dumps(selections, ensure_ascii=False), tags,
+         json.dumps(clips, ensure_ascii=False), status, created_at)
+    )
+    if not cursor.rowcount:
+        # 已經寫入的歌曲只更新 clip 資訊，例如本地影片先完成、之後才收到 Suno 的影片網址
+        conn.execute("UPDATE songs SET clips = ?, status = ? WHERE song_id = ?",
+                     (json.dumps(clips, ensure_ascii=False), status, song_id))
+        return False
+    row_id = cursor.lastrowid
+    conn.executemany(
+        "INSERT OR IGNORE INTO song_options (category, option, song) VALUES (?, ?, ?)",
+        [(category, option, row_id) for category, options in selections.items() for option in options]
+    )
+    conn.execute(
+        "INSERT INTO songs_fts (rowid, theme, lyrics, selections, meta) VALUES (?, ?, ?, ?, ?)",
+        (row_id, segment(theme), segment(lyrics), segment(_selections_text(selections)), meta)
+    )
+    _stats["recorded"] += 1
+    metrics.inc("song_history_recorded_total")
+    return True
+
+def record(song_id, style, theme, lyrics, selections, tags, clips, status, created_at):
+    # with conn 在離開時提交或回滾，略過重複的歌曲時也不會留下未結束的寫入交易
+    with _lock:
+        conn = _connection()
+        with conn:
+            return _insert(conn, song_id, style, theme, lyrics, selections, tags, clips, status, created_at)
+
+def _job_fields(job):
+    return (job["id"], job.get("style"), job["theme"], job["lyrics"], job.get("selections") or {},
+            job.get("tags"), job["clips"], job["status"], job["created_at"])
+
+def record_job(job):
+    # 註冊為工作狀態的 listener，工作結束且有音檔時寫入歌曲庫
+    if job["status"] not in RECORDED_STATES or not job["clips"]:
+        return False
+    return record(*_job_fields(job))
+
+def backfill():
+    # 一次性的移轉：加入歌曲庫之前已完成的工作只在工作紀錄中，第一次建立歌曲庫時在同一個交易中補進來，
+    # 之後的工作由 listener 寫入，重啟時不再掃描工作紀錄
+    global _backfilled
+    with _lock:
+        if _backfilled:
+            return 0
+        _backfilled = True
+        conn = _connection()
+        if conn.execute("SELECT 1 FROM history_meta WHERE key = 'backfilled'").fetchone():
+            return 0
+        with conn:
+            count = sum(1 for job in jobstore.finished_jobs(RECORDED_STATES)
+                        if job["clips"] and _insert(conn, *_job_fields(job)))
+            conn.execute("INSERT INTO history_meta (key, value) VALUES ('backfilled', ?)", (str(time.time()),))
+    return count
+
+def _song(row):
+    row_id, song_id, style, theme, lyrics, selections, tags, clips, status, created_at = row
+    return {"id": row_id, "song_id": song_id, "style": style, "theme": theme, "lyrics": lyrics,
+            "selections": json.loads(selections), "tags": tags, "clips": json.loads(clips),
+            "status": status, "created_at": created_at}
+
+def page(query="", style=None, category=None, option=None, cursor=None, limit=PAGE_SIZE):
+    # keyset 分頁：由新到舊依 id 排序，cursor 是上一頁最後一首的 id，不論翻到第幾頁都只讀一頁的資料。
+    # 搜尋時由全文索引依 rowid 倒序逐筆比對，湊滿一頁就停止，不必先找出所有符合的歌曲再排序。
+    # 回傳 (歌曲, 下一頁的 cursor)，沒有下一頁時 cursor 為 None
+    conditions = []
+    params = []
+    match = match_query(query)
+    if match:
+        source = "songs_fts JOIN songs ON songs.id = songs_fts.rowid"
+        order = "songs_fts.rowid"
+        conditions.append("songs_fts MATCH ?")
+        params.append(match)
+    else:
+        source = "songs"
+        order = "songs.id"
+    if style:
+        conditions.append("songs.style = ?")
+        params.append(style)
+    if category and option:
+        conditions.append("songs.id IN (SELECT song FROM song_options WHERE category = ? AND option = ?)")
+        params.extend([category, option])
+    if cursor:
+        conditions.append(f"{order} < ?")
+        params.append(cursor)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    start = time.perf_counter()
+    with _lock:
+        rows = _connection().execute(
+            f"""SELECT songs.id, song_id, style, songs.theme, songs.lyrics, songs.selections, tags, clips, status, created_at
+                FROM {source} {where} ORDER BY {order} DESC LIMIT ?""",
+            (*params, limit + 1)
+        ).fetchall()
+        _stats["pages"] += 1
+        _stats["searches"] += 1 if match else 0
+        _stats["query_seconds"] += time.perf_counter() - start
+    metrics.inc("song_history_queries_total", {"kind": "search" if match else "browse"})
+    songs = [_song(row) for row in rows[:limit]]
+    next_cursor = songs[-1]["id"] if len(rows) > limit else None
+    return songs, next_cursor
+
+def options(category):
+    # 某個類別曾經選過的選項，供歌曲庫篩選
+    with _lock:
+        rows = _connection().execute(
+            "SELECT DISTINCT option FROM song_options WHERE category = ? ORDER BY option", (category,)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+def history_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["songs"] = _connection().execute("SELECT count(*) FROM songs").fetchone()[0]
+    stats["avg_query_ms"] = stats["query_seconds"] / stats["pages"] * 1000 if stats["pages"] else 0.0
+    return stats
+
+metrics.describe("song_history_recorded_total", "counter", "Finished songs written to the searchable history store.")
+metrics.describe("song_history_queries_total", "counter", "History gallery page queries, by kind (browse or full-text search).")
@@ -0,0 +1,256 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import accounts
+import admission
+import media
+import poller
+import renderer
+import waveform
+import mastering
+import jobstore
+from clients import get_suno_client, invalidate_suno_client
+from metrics import timed
+
+# Constants
+MAX_WORKERS = 8  # 同時進行的生成工作數
+MEDIA_WORKERS = 4  # 同時進行的音檔後製（下載、正規化、波形、送出繪製），不佔用生成工作的執行緒
+POOL_ACCOUNT = ""  # 尚未分配帳號的工作，放行時由帳號池挑選
+
+# 工作狀態
+QUEUED = "queued"
+GENERATING = "generating"
+WAITING_VIDEO = "waiting_video"
+DONE = "done"
+FAILED = "failed"
+TIMEOUT = "timeout"
+FINISHED_STATES = (DONE, FAILED, TIMEOUT)
+
+_lock = threading.Lock()
+_jobs = {}
+_resumed = set()
+_orphans_settled = False
+_listeners = []  # 每次工作狀態改變時呼叫 listener(job)，例如推送狀態給頁面
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="music-job")
+_media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="music-media")
+
+def add_listener(listener):
+    with _lock:
+        if listener not in _listeners:
+            _listeners.append(listener)
+
+def _notify(job):
+    # 在 _lock 之外呼叫，傳入副本；listener 的錯誤不影響工作本身
+    for listener in list(_listeners):
+        try:
+            listener(job)
+        except Exception:
+            pass
+
+def _update(job_id, **fields):
+    # 每次狀態改變都寫入工作紀錄，重啟後可以接續
+    with _lock:
+        job = _jobs[job_id]
+        job.update(fields)
+        job["updated_at"] = time.time()
+        jobstore.save_job(job)
+        snapshot = _copy(job)
+    _notify(snapshot)
+
+def _update_clip(job_id, clip_id, **fields):
+    # 所有版本都結束後才結束工作；只要有一個版本有影片就算完成
+    with _lock:
+        job = _jobs[job_id]
+        for clip in job["clips"]:
+            if clip["id"] == clip_id:
+                clip.update(fields)
+                # 本地影片已經完成時，Suno 影片超時不影響這個版本
+                if clip["status"] == TIMEOUT and clip.get("local_video"):
+                    clip["status"] = DONE
+        statuses = [clip["status"] for clip in job["clips"]]
+        if WAITING_VIDEO not in statuses:
+            if DONE in statuses:
+                job["status"] = DONE
+                job["error"] = None
+            else:
+                job["status"] = TIMEOUT
+                job["error"] = "影片生成超時，請稍後再試。"
+        job["updated_at"] = time.time()
+        jobstore.save_job(job)
+        snapshot = _copy(job)
+    _notify(snapshot)
+
+@timed("suno")
+def generate_clips(cookie, lyrics, theme, tags, title_length):
+    try:
+        clips = get_suno_client(cookie).generate(
+            prompt=lyrics,
+            tags=tags,
+            title=theme[:title_length],
+            make_instrumental=False,
+            is_custom=True,
+            wait_audio=True
+        )
+    except Exception:
+        invalidate_suno_client(cookie)
+        accounts.record_failure(cookie)
+        raise
+    accounts.record_success(cookie)
+    return clips
+
+def _run_music_job(job_id, cookie, lyrics, theme, tags, title_length):
+    # 生成的 clip 屬於放行時選中的帳號，之後的影片輪詢也必須用同一個帳號
+    _update(job_id, status=GENERATING, account=jobstore.account_key(cookie))
+    try:
+        clips = generate_clips(cookie, lyrics, theme, tags, title_length)
+    except Exception as e:
+        _update(job_id, status=FAILED, error=f"生成歌曲時發生錯誤: {str(e)}")
+        return
+    finally:
+        admission.release(cookie)
+    clips = [clip for clip in clips or [] if clip.audio_url]
+    if not clips:
+        _update(job_id, status=FAILED, error="音樂生成失敗")
+        return
+
+    # 一次 generate 會產生兩個版本，全部保留並一起追蹤影片狀態
+    _update(job_id, status=WAITING_VIDEO, clips=[
+        {"id": clip.id, "audio_url": clip.audio_url, "video_url": None,
+         "status": WAITING_VIDEO, "video_checks": 0}
+        for clip in clips
+    ])
+    _watch_clips(job_id, cookie, [clip.id for clip in clips])
+    for clip in clips:
+        _media_executor.submit(_process_audio, job_id, clip.id, clip.audio_url, lyrics, theme[:title_length])
+
+def _process_audio(job_id, clip_id, audio_url, lyrics, title):
+    # 音檔下載到本地媒體庫後依序：響度正規化與裁切、計算波形、在本地繪製歌詞影片（各自可停用）
+    audio_path = media.fetch(clip_id, audio_url, "mp3")
+    if not audio_path:
+        return
+    audio_path = mastering.master_clip(clip_id, audio_path)
+    waveform.ensure_peaks(clip_id, mastering.served_ext(clip_id))
+    # 本地影片完成時這個版本就可以播放；video_url 仍等 Suno 的輪詢結果，本地檔案被淘汰後改播 Suno 的影片
+    renderer.render_clip(clip_id, audio_path, lyrics, title,
+                         lambda clip_id: _update_clip(job_id, clip_id, local_video=True, status=DONE))
+
+def _watch_clips(job_id, cookie, clip_ids):
+    # 影片狀態交給共用的輪詢器批次查詢，工作執行緒可以立即釋放
+    def on_video(clip_id, video_url, checks):
+        _update_clip(job_id, clip_id, video_url=video_url, video_checks=checks,
+                     status=DONE if video_url else TIMEOUT)
+        if video_url:
+            _media_executor.submit(media.fetch, clip_id, video_url, "mp4")
+
+    for clip_id in clip_ids:
+        poller.watch(cookie, clip_id, on_video)
+
+def _enqueue(job_id, cookie, lyrics, theme, tags, title_length):
+    # 依點數與 Suno 速率限制排隊，放行後才交給工作池；cookie 為 None 時由帳號池分配帳號
+    admission.enqueue(
+        job_id,
+        cookie,
+        lambda cookie: _executor.submit(_run_music_job, job_id, cookie, lyrics, theme, tags, title_length),
+        lambda message: _update(job_id, status=FAILED, error=message)
+    )
+
+def submit_music_job(cookie, lyrics, theme, tags, title_length, style_id=None, selections=None):
+    # cookie 為 None 時交給帳號池，放行時分配到最空閒且點數足夠的帳號
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    job = {
+        "id": job_id,
+        "status": QUEUED,
+        "account": jobstore.account_key(cookie) if cookie else POOL_ACCOUNT,
+        "style": style_id,
+        "selections": selections or {},
+        "lyrics": lyrics,
+        "theme": theme,
+        "tags": tags,
+        "title_length": title_length,
+        "clips": [],
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    with _lock:
+        _jobs[job_id] = job
+        jobstore.save_job(job)
+    _enqueue(job_id, cookie, lyrics, theme, tags, title_length)
+    return job_id
+
+def resume_jobs(cookies):
+    # 伺服器重啟後，接續帳號池中各帳號以及尚未分配帳號的未完成工作；每個帳號在每個進程只執行一次
+    owners = {jobstore.account_key(cookie): cookie for cookie in cookies}
+    owners[POOL_ACCOUNT] = None
+    resumed = 0
+    for account, cookie in owners.items():
+        with _lock:
+            if account in _resumed:
+                continue
+            _resumed.add(account)
+        jobs = jobstore.unfinished_jobs(account, FINISHED_STATES)
+        for job in jobs:
+            _resume_job(job, cookie)
+        resumed += len(jobs)
+    _settle_orphans(list(owners))
+    return resumed
+
+def _settle_orphans(accounts):
+    # 帳號已不在帳號池中的工作無法再用原本的帳號輪詢或生成，結束這些工作，重新連接的分頁不會一直輪詢
+    global _orphans_settled
+    with _lock:
+        if _orphans_settled:
+            return
+        _orphans_settled = True
+    for job in jobstore.orphaned_jobs(accounts, FINISHED_STATES):
+        with _lock:
+            _jobs[job["id"]] = job
+        if job["status"] == QUEUED:
+            # 還沒送出生成請求，改由帳號池分配帳號
+            _update(job["id"], account=POOL_ACCOUNT)
+            _enqueue(job["id"], None, job["lyrics"], job["theme"], job["tags"], job["title_length"])
+        elif job["status"] == WAITING_VIDEO:
+            # 音檔仍然可以播放；還在等影片的版本視為超時，本地影片完成時一樣改為完成
+            clips = [clip for clip in job["clips"] if clip["status"] == WAITING_VIDEO]
+            for clip in clips:
+                _update_clip(job["id"], clip["id"], status=TIMEOUT)
+            for clip in clips:
+                _media_executor.submit(_process_audio, job["id"], clip["id"], clip["audio_url"], job["lyrics"],
+                                       job["theme"][:job["title_length"]])
+        else:
+            _update(job["id"], status=FAILED, error="生成帳號已從帳號池移除，生成中斷，請重新生成。")
+
+def _resume_job(job, cookie):
+    with _lock:
+        _jobs[job["id"]] = job
+    if job["status"] == QUEUED:
+        _enqueue(job["id"], cookie, job["lyrics"], job["theme"], job["tags"], job["title_length"])
+    elif job["status"] == WAITING_VIDEO:
+        clips = [clip for clip in job["clips"] if clip["status"] == WAITING_VIDEO]
+        _watch_clips(job["id"], cookie, [clip["id"] for clip in clips])
+        for clip in clips:
+            _media_executor.submit(_process_audio, job["id"], clip["id"], clip["audio_url"], job["lyrics"],
+                                   job["theme"][:job["title_length"]])
+    else:
+        # 生成請求進行到一半就中斷，無法得知 Suno 是否已扣點，不自動重送
+        _update(job["id"], status=FAILED, error="伺服器重新啟動，生成中斷，請重新生成。")
+
+def _copy(job):
+    return {**job, "clips": [dict(clip) for clip in job["clips"]]}
+
+def get_job(job_id):
+    # 回傳副本，避免頁面讀取時與背景執行緒互相干擾；不在記憶體中時從工作紀錄讀取
+    with _lock:
+        job = _jobs.get(job_id)
+        if job:
+            return _copy(job)
+    return jobstore.load_job(job_id)
+
+def active_job_count():
+    with _lock:
+        return sum(1 for job in _jobs.values() if job["status"] not in FINISHED_STATES)
+
+def job_stats():
+    return {"active_jobs": active_job_count(), **poller.poller_stats()}
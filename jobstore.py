@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+# Constants
+JOBS_PATH = os.path.join("data", "jobs.sqlite3")
+
+# 工作紀錄寫入 SQLite，重新整理頁面、關閉分頁或重啟伺服器後都還能找回
+_lock = threading.Lock()
+_conn = None
+
+def _connection():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(JOBS_PATH), exist_ok=True)
+        _conn = sqlite3.connect(JOBS_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                account TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        _conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+    return _conn
+
+def account_key(cookie):
+    # 不保存 cookie 本身，只保存可比對的雜湊值
+    return hashlib.sha256(cookie.encode("utf-8")).hexdigest()[:16]
+
+def save_job(job):
+    with _lock:
+        conn = _connection()
+        conn.execute(
+            """INSERT OR REPLACE INTO jobs (id, status, account, data, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (job["id"], job["status"], job["account"], json.dumps(job, ensure_ascii=False),
+             job["created_at"], job["updated_at"])
+        )
+        conn.commit()
+
+def load_job(job_id):
+    with _lock:
+        row = _connection().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def unfinished_jobs(account, finished_states):
+    placeholders = ", ".join("?" for _ in finished_states)
+    with _lock:
+        rows = _connection().execute(
+            f"SELECT data FROM jobs WHERE account = ? AND status NOT IN ({placeholders}) ORDER BY created_at",
+            (account, *finished_states)
+        ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+def orphaned_jobs(accounts, finished_states):
+    # 未完成、且帳號已不在帳號池中的工作（例如 cookie 更換之後）
+    account_placeholders = ", ".join("?" for _ in accounts)
+    placeholders = ", ".join("?" for _ in finished_states)
+    with _lock:
+        rows = _connection().execute(
+            f"""SELECT data FROM jobs WHERE account NOT IN ({account_placeholders})
+                AND status NOT IN ({placeholders}) ORDER BY created_at""",
+            (*accounts, *finished_states)
+        ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+def finished_jobs(states):
+    placeholders = ", ".join("?" for _ in states)
+    with _lock:
+        rows = _connection().execute(
+            f"SELECT data FROM jobs WHERE status IN ({placeholders}) ORDER BY created_at", tuple(states)
+        ).fetchall()
+    return [json.loads(row[0]) for row in rows]
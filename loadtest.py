@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from suno import Suno
+import accounts
+import admission
+import cache
+import generation
+import jobstore
+import media
+import metrics
+import mastering
+import poller
+import renderer
+import structure
+import transport
+from clients import get_openai_client
+from fakes import LatencyModel, start_fake_openai, start_fake_suno
+from generation import generate_lyrics, generate_lyrics_stream, generate_theme, ensure_structure
+from jobs import submit_music_job, get_job, FINISHED_STATES, QUEUED, GENERATING
+from styles import get_style, list_styles, DEFAULT_STYLE
+
+# 離線壓力測試：啟動本地的 OpenAI 與 Suno 替身伺服器，讓 N 個模擬 session 同時走完
+# app.py 的流程（歌詞 → 主題 → 送出音樂工作 → 等待影片），不會花到真正的點數。
+#
+#   python loadtest.py --sessions 50 --concurrency 10 --audio-delay 5 --video-delay 30
+
+FAKE_COOKIE = "loadtest-cookie"
+FAKE_API_KEY = "loadtest-key"
+STAGES = ("lyrics", "theme", "suno", "video")
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def random_selections(style):
+    # 每個類別隨機挑一到兩個選項，模擬使用者的選擇
+    return {
+        category: random.sample(options, min(len(options), random.randint(1, 2)))
+        for category, options in style["categories"].items()
+    }
+
+def isolate_storage(workdir):
+    # 快取、工作紀錄與媒體都寫到暫存目錄，不影響正式資料
+    cache.CACHE_PATH = os.path.join(workdir, "generation_cache.sqlite3")
+    jobstore.JOBS_PATH = os.path.join(workdir, "jobs.sqlite3")
+    media.MEDIA_DIR = os.path.join(workdir, "media")
+
+def run_session(client, style, stream):
+    # 與 app.py 相同的步驟，回傳各階段耗時與最後狀態
+    timings = {}
+    selections = random_selections(style)
+    start = time.perf_counter()
+    try:
+        if stream:
+            lyrics = "".join(generate_lyrics_stream(client, style, selections, {}))
+        else:
+            lyrics = generate_lyrics(client, style, selections)
+        lyrics, _, _ = ensure_structure(client, style, lyrics)
+        timings["lyrics"] = time.perf_counter() - start
+
+        stage_start = time.perf_counter()
+        theme = generate_theme(client, lyrics)
+        timings["theme"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        job_id = submit_music_job(None, lyrics, theme, style["suno_tags"], style["max_title_length"],
+                                  style_id=style["id"], selections=selections)
+        job = get_job(job_id)
+        while job["status"] in (QUEUED, GENERATING):
+            time.sleep(0.2)
+            job = get_job(job_id)
+        timings["suno"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        while job["status"] not in FINISHED_STATES:
+            time.sleep(0.2)
+            job = get_job(job_id)
+        if job["clips"]:
+            timings["video"] = time.perf_counter() - stage_start
+        status = job["status"]
+    except Exception as e:
+        status = f"error: {type(e).__name__}"
+    timings["total"] = time.perf_counter() - start
+    return status, timings
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.2f}"
+
+def print_report(elapsed, results, fake_openai, fake_suno):
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    done = statuses.get("done", 0)
+    print(f"共 {len(results)} 個 session，耗時 {elapsed:.1f} 秒")
+    print("結果: " + ", ".join(f"{status} {count}" for status, count in sorted(statuses.items())))
+    if elapsed > 0:
+        print(f"吞吐量: {done / elapsed * 60:.2f} 首/分鐘")
+    print(f"{'階段':<8}{'次數':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for stage in STAGES + ("total",):
+        values = [timings[stage] for _, timings in results if stage in timings]
+        print(f"{stage:<10}{len(values):>6}" + "".join(
+            f"{format_seconds(percentile(values, q)):>9}" for q in (0.5, 0.95, 0.99, 1.0)))
+    print("上游呼叫次數:")
+    for name, fake in (("openai", fake_openai), ("suno", fake_suno)):
+        for endpoint, count in sorted(fake.calls.items()):
+            print(f"  {name}.{endpoint}: {count}")
+    print("輪詢器: " + json.dumps(poller.poller_stats(), ensure_ascii=False))
+    print("音檔後製: " + json.dumps(mastering.mastering_stats(), ensure_ascii=False))
+    print("本地影片: " + json.dumps(renderer.renderer_stats(), ensure_ascii=False))
+    print("連線池: " + json.dumps(transport.transport_stats(), ensure_ascii=False))
+    print("排隊: " + json.dumps(admission.admission_stats(), ensure_ascii=False, default=str))
+    for stats in accounts.account_stats():
+        print(f"  帳號 {stats['account'][:8]}: 分配 {stats['jobs']}，錯誤 {stats['errors']}，"
+              f"移出 {stats['ejections']} 次，狀態 {stats['state']}")
+    print("提示詞: " + json.dumps(generation.prompt_stats(), ensure_ascii=False))
+    print("歌詞結構: " + json.dumps(structure.structure_stats(), ensure_ascii=False))
+
+def main():
+    parser = argparse.ArgumentParser(description="離線壓力測試(Offline load test)")
+    parser.add_argument("--sessions", type=int, default=20, help="模擬的 session 總數")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時進行的 session 數")
+    parser.add_argument("--style", default=DEFAULT_STYLE, choices=list(list_styles()))
+    parser.add_argument("--stream", action="store_true", help="以串流方式產生歌詞")
+    parser.add_argument("--openai-latency", type=float, default=1.0, help="OpenAI 延遲中位數（秒）")
+    parser.add_argument("--openai-sigma", type=float, default=0.5, help="OpenAI 延遲的對數常態標準差")
+    parser.add_argument("--openai-failure-rate", type=float, default=0.0)
+    parser.add_argument("--token-delay", type=float, default=0.01, help="串流每個片段的間隔（秒）")
+    parser.add_argument("--suno-latency", type=float, default=0.3, help="Suno 延遲中位數（秒）")
+    parser.add_argument("--suno-sigma", type=float, default=0.5)
+    parser.add_argument("--suno-failure-rate", type=float, default=0.0)
+    parser.add_argument("--audio-delay", type=float, default=5, help="音檔完成所需秒數")
+    parser.add_argument("--video-delay", type=float, default=30, help="影片完成所需秒數")
+    parser.add_argument("--media-file", help="替身 CDN 回傳的 mp3 檔，用於測試本地影片繪製")
+    parser.add_argument("--credits", type=int, default=100000, help="替身帳號的點數")
+    parser.add_argument("--openai-rate", type=float, help="覆寫 OpenAI token bucket 每秒補充數")
+    parser.add_argument("--suno-rate", type=float, help="覆寫每個 Suno 帳號 token bucket 每秒補充數")
+    parser.add_argument("--accounts", type=int, default=1, help="帳號池中的替身 Suno 帳號數")
+    args = parser.parse_args()
+
+    fake_openai = start_fake_openai(LatencyModel(args.openai_latency, args.openai_sigma, args.openai_failure_rate),
+                                    token_delay=args.token_delay)
+    fake_suno = start_fake_suno(LatencyModel(args.suno_latency, args.suno_sigma, args.suno_failure_rate),
+                                audio_delay=args.audio_delay, video_delay=args.video_delay, credits=args.credits,
+                                media_file=args.media_file)
+    # 在建立任何客戶端之前把上游指向替身伺服器
+    os.environ["OPENAI_BASE_URL"] = fake_openai.url + "/v1"
+    Suno.BASE_URL = fake_suno.url
+    Suno.CLERK_BASE_URL = fake_suno.url
+    if args.openai_rate:
+        admission.buckets["openai"] = admission.TokenBucket(args.openai_rate, admission.RATE_LIMITS["openai"][1])
+    if args.suno_rate:
+        admission.RATE_LIMITS["suno"] = (args.suno_rate, admission.RATE_LIMITS["suno"][1])
+    accounts.configure([f"{FAKE_COOKIE}-{index}" for index in range(args.accounts)])
+
+    style = get_style(args.style)
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        isolate_storage(workdir)
+        client = get_openai_client(FAKE_API_KEY)
+        metrics.start_server()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="session") as executor:
+            futures = [executor.submit(run_session, client, style, args.stream) for _ in range(args.sessions)]
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+        print_report(elapsed, results, fake_openai, fake_suno)
+    fake_openai.stop()
+    fake_suno.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import media
+import metrics
+
+# 音檔後製：EBU R128 響度正規化、去除前後靜音、加上淡入淡出，結果以 clip id 存進媒體庫。
+# 每個 clip 在獨立的 Python 子進程中處理（python mastering.py 輸入 輸出），
+# 解碼與編碼都透過 ffmpeg 串流，numpy 一次只處理一段，記憶體用量與歌曲長度無關。
+#
+#   python mastering.py --benchmark a.mp3 b.mp3 --repeat 4   # 測量每核心每秒處理的 clip 數
+
+# Constants
+MASTERING_ENABLED = os.environ.get("AUDIO_MASTERING", "1") != "0"
+FFMPEG = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+TARGET_LUFS = -14.0  # 串流平台常用的整體響度
+MAX_PEAK_DB = -1.0  # 提高音量時峰值不超過 -1 dBFS
+SILENCE_DB = -50.0  # 低於此音量視為靜音
+FRAME_SECONDS = 0.05  # 判斷靜音的音框長度
+LEAD_PAD = 0.1  # 去除前段靜音後保留的秒數
+TAIL_PAD = 0.5  # 去除尾段靜音後保留的秒數
+FADE_IN = 0.05  # 避免開頭爆音的淡入
+FADE_OUT = 3.0
+SAMPLE_RATE = 44100
+CHANNELS = 2
+CHUNK_SECONDS = 5
+BITRATE = "192k"
+MASTERING_WORKERS = os.cpu_count() or 2  # 同時執行的後製子進程數
+MASTERING_TIMEOUT = 300
+OUTPUT_EXT = "norm.mp3"
+
+_LOUDNESS_RE = re.compile(r"I:\s+(-?\d+(?:\.\d+)?|-inf) LUFS")
+
+_lock = threading.Lock()
+_pool = None
+_stats = {"processed": 0, "errors": 0, "seconds": 0.0, "trimmed_seconds": 0.0}
+
+def enabled():
+    return MASTERING_ENABLED and shutil.which(FFMPEG) is not None
+
+def _decode(audio_path, filters=None):
+    command = [FFMPEG, "-hide_banner", "-nostats", "-i", audio_path]
+    if filters:
+        command += ["-af", filters]
+    command += ["-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "-f", "f32le", "-"]
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE if filters else subprocess.DEVNULL)
+
+def _chunks(process):
+    # 每次讀取 CHUNK_SECONDS 秒的 PCM，回傳 (取樣數, 聲道數) 的陣列
+    frame_bytes = CHANNELS * 4
+    leftover = b""
+    while True:
+        data = process.stdout.read(SAMPLE_RATE * CHUNK_SECONDS * frame_bytes)
+        if not data:
+            break
+        data = leftover + data
+        usable = len(data) // frame_bytes * frame_bytes
+        leftover = data[usable:]
+        if usable:
+            yield np.frombuffer(data[:usable], dtype=np.float32).reshape(-1, CHANNELS)
+
+def analyze(audio_path):
+    # 第一次解碼：ffmpeg 的 ebur128 量測整體響度，numpy 計算每個音框的音量與峰值
+    process = _decode(audio_path, "ebur128=framelog=quiet")
+    frame = int(SAMPLE_RATE * FRAME_SECONDS)
+    levels = []
+    peak = 0.0
+    total = 0
+    carry = np.empty((0, CHANNELS), dtype=np.float32)
+    for chunk in _chunks(process):
+        total += len(chunk)
+        peak = max(peak, float(np.abs(chunk).max()))
+        samples = np.concatenate([carry, chunk])
+        usable = len(samples) // frame * frame
+        if usable:
+            frames = samples[:usable].reshape(-1, frame, CHANNELS)
+            rms = np.sqrt(np.mean(frames ** 2, axis=(1, 2)))
+            levels.append(20 * np.log10(np.maximum(rms, 1e-10)))
+        carry = samples[usable:]
+    stderr = process.stderr.read().decode("utf-8", "replace")
+    if process.wait(timeout=MASTERING_TIMEOUT) != 0 or not total:
+        raise RuntimeError(f"ffmpeg 解碼失敗: {audio_path}")
+    matches = _LOUDNESS_RE.findall(stderr)
+    loudness = float(matches[-1]) if matches and matches[-1] != "-inf" else None
+    levels = np.concatenate(levels) if levels else np.empty(0)
+    return {"loudness": loudness, "peak": peak, "duration": total / SAMPLE_RATE, "levels": levels}
+
+def plan(analysis):
+    # 依分析結果決定保留的區間與增益（dB）
+    duration = analysis["duration"]
+    loud = np.nonzero(analysis["levels"] > SILENCE_DB)[0]
+    if len(loud):
+        start = max(0.0, loud[0] * FRAME_SECONDS - LEAD_PAD)
+        end = min(duration, (loud[-1] + 1) * FRAME_SECONDS + TAIL_PAD)
+    else:
+        start, end = 0.0, duration
+    gain_db = 0.0
+    if analysis["loudness"] is not None:
+        gain_db = TARGET_LUFS - analysis["loudness"]
+    if analysis["peak"] > 0:
+        # 只用增益不用限幅器，峰值不足的空間就少調一點
+        gain_db = min(gain_db, MAX_PEAK_DB - 20 * np.log10(analysis["peak"]))
+    return {"start": start, "end": end, "gain_db": float(gain_db)}
+
+def _envelope(positions, start, end):
+    # positions 為每個取樣相對於原始音檔的秒數，回傳淡入淡出的倍率
+    fade_in = np.clip((positions - start) / FADE_IN, 0.0, 1.0)
+    fade_out = np.clip((end - positions) / min(FADE_OUT, max(end - start, 1e-3) / 2), 0.0, 1.0)
+    return np.minimum(fade_in, fade_out).astype(np.float32)
+
+def process_file(audio_path, output_path):
+    # 兩次解碼：先分析，再把裁切、增益與淡入淡出後的 PCM 串流給 ffmpeg 編碼
+    start_time = time.perf_counter()
+    analysis = analyze(audio_path)
+    settings = plan(analysis)
+    gain = np.float32(10 ** (settings["gain_db"] / 20))
+    first = int(settings["start"] * SAMPLE_RATE)
+    last = int(settings["end"] * SAMPLE_RATE)
+    tmp_path = output_path + ".part"
+    encoder = subprocess.Popen(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-f", "f32le", "-ar", str(SAMPLE_RATE),
+         "-ac", str(CHANNELS), "-i", "-", "-c:a", "libmp3lame", "-b:a", BITRATE, "-f", "mp3", tmp_path],
+        stdin=subprocess.PIPE
+    )
+    decoder = _decode(audio_path)
+    position = 0
+    try:
+        for chunk in _chunks(decoder):
+            chunk_start = position
+            position += len(chunk)
+            lo, hi = max(first, chunk_start), min(last, position)
+            if lo >= hi:
+                continue
+            samples = chunk[lo - chunk_start:hi - chunk_start]
+            seconds = np.arange(lo, hi, dtype=np.float64) / SAMPLE_RATE
+            envelope = _envelope(seconds, settings["start"], settings["end"])
+            encoder.stdin.write((samples * (gain * envelope)[:, None]).astype(np.float32).tobytes())
+        encoder.stdin.close()
+        if encoder.wait(timeout=MASTERING_TIMEOUT) != 0:
+            raise RuntimeError(f"ffmpeg 編碼失敗: {output_path}")
+        os.replace(tmp_path, output_path)
+    finally:
+        for process in (decoder, encoder):
+            if process.poll() is None:
+                process.kill()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {
+        "loudness": analysis["loudness"],
+        "gain_db": settings["gain_db"],
+        "trimmed_seconds": analysis["duration"] - (settings["end"] - settings["start"]),
+        "seconds": time.perf_counter() - start_time,
+    }
+
+def _executor():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=MASTERING_WORKERS, thread_name_prefix="mastering")
+        return _pool
+
+def _run_worker(audio_path, output_path):
+    # 在獨立的 Python 子進程中處理，避免 numpy 運算佔用服務進程的 GIL
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), os.path.abspath(audio_path), os.path.abspath(output_path)],
+        capture_output=True, text=True, timeout=MASTERING_TIMEOUT, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def master_clip(clip_id, audio_path):
+    # 回傳後製後的檔案；停用或失敗時回傳原本的音檔。同一個 clip 只處理一次
+    output_path = media.media_path(clip_id, OUTPUT_EXT)
+    if os.path.exists(output_path):
+        return output_path
+    if not enabled():
+        return audio_path
+    try:
+        with metrics.track("mastering"):
+            result = _executor().submit(_run_worker, audio_path, output_path).result()
+    except Exception:
+        with _lock:
+            _stats["errors"] += 1
+        return audio_path
+    with _lock:
+        _stats["processed"] += 1
+        _stats["seconds"] += result["seconds"]
+        _stats["trimmed_seconds"] += result["trimmed_seconds"]
+    media.evict()
+    return output_path
+
+def served_ext(clip_id):
+    # 頁面播放的檔案：本地媒體有公開網址且後製版本還在時播放後製版本，否則播放原始音檔（本地或 CDN 的內容相同）
+    if media.MEDIA_PUBLIC_URL and media.is_cached(clip_id, OUTPUT_EXT):
+        return OUTPUT_EXT
+    return "mp3"
+
+def mastering_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["enabled"] = enabled()
+    stats["avg_seconds"] = stats["seconds"] / stats["processed"] if stats["processed"] else 0.0
+    return stats
+
+def benchmark(paths, repeat):
+    # 透過與服務相同的子進程池處理多個檔案，回報每核心每秒處理的 clip 數
+    jobs = [path for path in paths for _ in range(repeat)]
+    with tempfile.TemporaryDirectory(prefix="mastering-") as workdir:
+        start = time.perf_counter()
+        futures = [
+            _executor().submit(_run_worker, path, os.path.join(workdir, f"{index}.mp3"))
+            for index, path in enumerate(jobs)
+        ]
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+    cores = min(MASTERING_WORKERS, os.cpu_count() or 1)
+    print(f"處理 {len(results)} 個 clip，耗時 {elapsed:.2f} 秒，使用 {cores} 核心")
+    print(f"吞吐量: {len(results) / elapsed:.2f} clip/秒，每核心 {len(results) / elapsed / cores:.2f} clip/秒")
+    print(f"單一 clip 平均 {sum(result['seconds'] for result in results) / len(results):.2f} 秒")
+    for path in paths:
+        result = next(result for job, result in zip(jobs, results) if job == path)
+        print(f"  {os.path.basename(path)}: 響度 {result['loudness']} LUFS，增益 {result['gain_db']:+.1f} dB，"
+              f"去除 {result['trimmed_seconds']:.1f} 秒靜音")
+
+def main():
+    parser = argparse.ArgumentParser(description="音檔後製(Audio mastering)")
+    parser.add_argument("paths", nargs="+", help="輸入檔與輸出檔，或 --benchmark 時的多個輸入檔")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--repeat", type=int, default=1, help="benchmark 時每個檔案處理的次數")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.paths, args.repeat)
+        return
+    input_path, output_path = args.paths
+    print(json.dumps(process_file(input_path, output_path)))
+
+if __name__ == "__main__":
+    main()
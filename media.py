@@ -0,0 +1,181 @@
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import transport
+
+# Constants
+MEDIA_DIR = os.path.join(".cache", "media")
+MEDIA_MAX_BYTES = 2 * 1024 ** 3  # 本地媒體最多佔用 2GB，超過時淘汰最久未使用的檔案
+MEDIA_HOST = "0.0.0.0"
+MEDIA_PORT = int(os.environ.get("MEDIA_PORT", "8502"))
+# 瀏覽器要能連到的本地媒體網址；沒有設定時頁面繼續使用 CDN 網址，本地檔案只供後製、波形與繪製使用
+MEDIA_PUBLIC_URL = os.environ.get("MEDIA_PUBLIC_URL")
+CHUNK_SIZE = 256 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+_lock = threading.Lock()
+_download_locks = {}
+_server = None
+_stats = {"downloads": 0, "download_bytes": 0, "hits": 0, "evictions": 0, "download_errors": 0}
+
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+def media_path(clip_id, ext):
+    return os.path.join(MEDIA_DIR, f"{clip_id}.{ext}")
+
+def is_cached(clip_id, ext):
+    return os.path.exists(media_path(clip_id, ext))
+
+def _touch(path):
+    # 用修改時間記錄最近使用時間，作為 LRU 淘汰依據
+    now = time.time()
+    os.utime(path, (now, now))
+
+def fetch(clip_id, url, ext):
+    # 每個檔案只下載一次，同時多個請求時其他人等待同一次下載
+    path = media_path(clip_id, ext)
+    with _lock:
+        download_lock = _download_locks.setdefault(path, threading.Lock())
+    with download_lock:
+        if os.path.exists(path):
+            _touch(path)
+            with _lock:
+                _stats["hits"] += 1
+            return path
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        tmp_path = path + ".part"
+        size = 0
+        try:
+            with transport.media_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with _lock:
+                _stats["download_errors"] += 1
+            return None
+    with _lock:
+        _stats["downloads"] += 1
+        _stats["download_bytes"] += size
+    evict()
+    return path
+
+def evict():
+    with _lock:
+        if not os.path.isdir(MEDIA_DIR):
+            return
+        files = []
+        for name in os.listdir(MEDIA_DIR):
+            if name.endswith(".part"):
+                continue
+            path = os.path.join(MEDIA_DIR, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= MEDIA_MAX_BYTES:
+                break
+            os.remove(path)
+            total -= size
+            _stats["evictions"] += 1
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    # 支援 Range 請求，讓播放器可以直接跳轉而不必下載整個檔案
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=MEDIA_DIR, **kwargs)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path) or path.endswith(".part"):
+            self.send_error(404, "File not found")
+            return None
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = _RANGE_RE.match(self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        f = open(path, "rb")
+        f.seek(start)
+        self._remaining = end - start + 1
+        _touch(path)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(self._remaining))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "public, max-age=86400")
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = self._remaining
+        while remaining > 0:
+            chunk = source.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server():
+    global _server
+    with _lock:
+        if _server is not None:
+            return
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        try:
+            _server = ThreadingHTTPServer((MEDIA_HOST, MEDIA_PORT), RangeRequestHandler)
+        except OSError:
+            # 其他進程已經在同一個埠口提供服務
+            _server = False
+            return
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="media-server", daemon=True).start()
+
+def media_url(clip_id, ext, fallback_url):
+    # 已經下載到本地且設定了公開網址時改用本地伺服器，否則使用原始 CDN 網址
+    if MEDIA_PUBLIC_URL and is_cached(clip_id, ext):
+        start_server()
+        return f"{MEDIA_PUBLIC_URL}/{clip_id}.{ext}"
+    return fallback_url
+
+def media_stats():
+    with _lock:
+        stats = dict(_stats)
+    total = 0
+    if os.path.isdir(MEDIA_DIR):
+        # 下載中的 .part 檔隨時會被改名或刪除，其他檔案也可能剛好被淘汰
+        for name in os.listdir(MEDIA_DIR):
+            if name.endswith(".part"):
+                continue
+            try:
+                total += os.path.getsize(os.path.join(MEDIA_DIR, name))
+            except FileNotFoundError:
+                continue
+    stats["stored_bytes"] = total
+    return stats
@@ -0,0 +1,167 @@
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Constants
+METRICS_HOST = "0.0.0.0"
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+# 歌詞約數秒、Suno 音檔約一分鐘、影片可能等到五分鐘，桶的範圍要涵蓋全部
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 180, 240, 300, 600)
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> 數值
+_gauges = {}
+_histograms = {}  # (name, labels) -> {"buckets": [...], "sum": 總和, "count": 次數}
+_help = {}
+_server = None
+
+def _labels_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+def describe(name, kind, text):
+    _help[name] = (kind, text)
+
+def inc(name, labels=None, amount=1):
+    with _lock:
+        key = (name, _labels_key(labels))
+        _counters[key] = _counters.get(key, 0) + amount
+
+def gauge_add(name, labels=None, amount=1):
+    with _lock:
+        key = (name, _labels_key(labels))
+        _gauges[key] = _gauges.get(key, 0) + amount
+
+def observe(name, value, labels=None):
+    with _lock:
+        key = (name, _labels_key(labels))
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            _histograms[key] = histogram
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+@contextmanager
+def track(stage):
+    # 記錄一個階段的耗時、錯誤與進行中的數量
+    gauge_add("song_stage_in_flight", {"stage": stage})
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("song_stage_errors_total", {"stage": stage})
+        raise
+    finally:
+        observe("song_stage_duration_seconds", time.perf_counter() - start, {"stage": stage})
+        gauge_add("song_stage_in_flight", {"stage": stage}, -1)
+
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_stream(stage):
+    # 串流產生器要等到最後一個 token 才算結束
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(stage):
+                yield from func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + list(extra or [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+def render():
+    # 輸出 Prometheus 文字格式
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: {**value, "buckets": list(value["buckets"])} for key, value in _histograms.items()}
+    described = set()
+
+    def header(name, kind):
+        if name in described:
+            return
+        described.add(name)
+        text = _help.get(name, (kind, name))[1]
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(gauges.items()):
+        header(name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(histograms.items()):
+        header(name, "histogram")
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def quantile(name, q, labels=None):
+    # 依直方圖估計分位數，供頁面顯示 p50/p95/p99
+    with _lock:
+        histogram = _histograms.get((name, _labels_key(labels)))
+        if not histogram or not histogram["count"]:
+            return None
+        target = q * histogram["count"]
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            if count >= target:
+                return bound
+    return float("inf")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server():
+    global _server
+    with _lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+        except OSError:
+            # 其他進程已經在同一個埠口提供服務
+            _server = False
+            return
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+
+describe("song_stage_duration_seconds", "histogram", "Latency of each song generation stage.")
+describe("song_stage_errors_total", "counter", "Errors raised by each song generation stage.")
+describe("song_stage_in_flight", "gauge", "Calls currently running in each song generation stage.")
+describe("song_video_poll_requests_total", "counter", "Batched get_songs calls made by the video poller.")
+describe("song_video_poll_attempts_total", "counter", "Per-clip video status checks made by the video poller.")
+describe("song_video_wait_seconds", "histogram", "Time from audio ready until the video is ready or times out.")
@@ -0,0 +1,143 @@
+import threading
+import time
+import accounts
+import metrics
+from clients import get_suno_client, invalidate_suno_client
+
+# Constants
+TICK_INTERVAL = 1  # 輪詢執行緒檢查到期工作的間隔秒數
+MIN_INTERVAL = 3  # 新生成的影片最短檢查間隔秒數
+MAX_INTERVAL = 30  # 較舊的影片最長檢查間隔秒數
+BACKOFF_RATIO = 0.1  # 檢查間隔隨影片年齡增加的比例
+MAX_WAIT = 300  # 最多等待5分鐘
+BATCH_SIZE = 20  # 每次 get_songs 最多查詢的 clip 數量
+
+# 進程內所有 session 共用一個輪詢執行緒，依憑證合併成批次查詢
+_lock = threading.Lock()
+_pending = {}  # (cookie, clip_id) -> 等待中的 clip 資料
+_thread = None
+
+_stats = {
+    "upstream_calls": 0,
+    "clips_checked": 0,
+    "clips_ready": 0,
+    "clips_timed_out": 0,
+    "errors": 0,
+}
+
+def _next_interval(age):
+    # 影片越舊越不常檢查，避免長時間等待的影片佔用上游請求
+    return min(MAX_INTERVAL, max(MIN_INTERVAL, age * BACKOFF_RATIO))
+
+def watch(cookie, clip_id, callback):
+    # callback(clip_id, video_url, checks)，video_url 為 None 代表超時
+    now = time.time()
+    with _lock:
+        entry = _pending.get((cookie, clip_id))
+        if entry:
+            entry["callbacks"].append(callback)
+        else:
+            _pending[(cookie, clip_id)] = {
+                "clip_id": clip_id,
+                "created_at": now,
+                "next_check": now + MIN_INTERVAL,
+                "checks": 0,
+                "callbacks": [callback],
+            }
+            metrics.gauge_add("song_stage_in_flight", {"stage": "video"})
+    _ensure_thread()
+
+def _ensure_thread():
+    global _thread
+    with _lock:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_run, name="video-poller", daemon=True)
+        _thread.start()
+
+def _finish(key, video_url):
+    with _lock:
+        entry = _pending.pop(key, None)
+        if not entry:
+            return
+        if video_url:
+            _stats["clips_ready"] += 1
+        else:
+            _stats["clips_timed_out"] += 1
+    metrics.gauge_add("song_stage_in_flight", {"stage": "video"}, -1)
+    metrics.observe("song_video_wait_seconds", time.time() - entry["created_at"],
+                    {"outcome": "ready" if video_url else "timeout"})
+    for callback in entry["callbacks"]:
+        try:
+            callback(entry["clip_id"], video_url, entry["checks"])
+        except Exception:
+            pass
+
+def _due_batches(now):
+    # 只要某個憑證有一個 clip 到期，就把該憑證所有等待中的 clip 一起查詢
+    batches = {}
+    with _lock:
+        due_cookies = {cookie for (cookie, _), entry in _pending.items() if entry["next_check"] <= now}
+        for (cookie, clip_id), entry in _pending.items():
+            if cookie in due_cookies:
+                batches.setdefault(cookie, []).append(clip_id)
+    return {
+        cookie: [clip_ids[i:i + BATCH_SIZE] for i in range(0, len(clip_ids), BATCH_SIZE)]
+        for cookie, clip_ids in batches.items()
+    }
+
+def _poll_batch(cookie, clip_ids):
+    with _lock:
+        _stats["upstream_calls"] += 1
+        _stats["clips_checked"] += len(clip_ids)
+    metrics.inc("song_video_poll_requests_total")
+    metrics.inc("song_video_poll_attempts_total", amount=len(clip_ids))
+    try:
+        with metrics.track("video_poll"):
+            songs = get_suno_client(cookie).get_songs(song_ids=",".join(clip_ids))
+    except Exception:
+        invalidate_suno_client(cookie)
+        accounts.record_failure(cookie)
+        with _lock:
+            _stats["errors"] += 1
+        songs = []
+    else:
+        accounts.record_success(cookie)
+
+    video_urls = {song.id: song.video_url for song in songs or [] if song.video_url}
+    now = time.time()
+    for clip_id in clip_ids:
+        key = (cookie, clip_id)
+        with _lock:
+            entry = _pending.get(key)
+            if not entry:
+                continue
+            entry["checks"] += 1
+            age = now - entry["created_at"]
+            entry["next_check"] = now + _next_interval(age)
+        if clip_id in video_urls:
+            _finish(key, video_urls[clip_id])
+        elif age >= MAX_WAIT:
+            _finish(key, None)
+
+def _run():
+    global _thread
+    while True:
+        with _lock:
+            if not _pending:
+                _thread = None
+                return
+        for cookie, batches in _due_batches(time.time()).items():
+            for clip_ids in batches:
+                _poll_batch(cookie, clip_ids)
+        time.sleep(TICK_INTERVAL)
+
+def pending_count():
+    with _lock:
+        return len(_pending)
+
+def poller_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["pending"] = len(_pending)
+    return stats
@@ -0,0 +1,146 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import media
+import metrics
+
+# 音檔下載完成後用 ffmpeg 在本地繪製歌詞影片（背景圖 + 依段落顯示的歌詞），
+# 不必等待 Suno 的影片。需要系統上有 ffmpeg 執行檔，找不到時自動停用並繼續等待 Suno。
+# 繪製工作在各自的 ffmpeg 子進程中執行，這裡的執行緒池只負責限制同時執行的進程數。
+
+# Constants
+LOCAL_VIDEO_RENDER = os.environ.get("LOCAL_VIDEO_RENDER", "1") != "0"
+FFMPEG = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+BACKGROUND_IMAGE = os.environ.get("VIDEO_BACKGROUND", os.path.join("assets", "background.jpg"))
+BACKGROUND_COLOR = "0x2b2118"  # 沒有背景圖時使用的底色
+VIDEO_SIZE = "1280x720"
+VIDEO_FPS = 5  # 靜態畫面只需要很低的幀率，繪製速度快很多
+FONT_NAME = "Noto Sans CJK TC"
+RENDER_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # 同時執行的 ffmpeg 進程數
+RENDER_TIMEOUT = 180
+INTRO_RATIO = 0.08  # 前奏約佔整首歌的比例，這段時間顯示歌名
+OUTRO_RATIO = 0.05
+
+_SECTION_RE = re.compile(r"^\s*\[[^\]]*\]\s*$")
+_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+_lock = threading.Lock()
+_pool = None
+_stats = {"rendered": 0, "errors": 0, "seconds": 0.0}
+
+def enabled():
+    return LOCAL_VIDEO_RENDER and shutil.which(FFMPEG) is not None
+
+def lyric_lines(lyrics):
+    # 去掉 [Verse1]、[Chorus] 等段落標記，只保留要顯示的歌詞行
+    lines = []
+    for line in lyrics.splitlines():
+        line = line.strip()
+        if line and not _SECTION_RE.match(line):
+            lines.append(line)
+    return lines
+
+def _timestamp(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+def build_subtitles(lyrics, title, duration):
+    # 前奏顯示歌名，其餘時間依每行字數比例分配給各行歌詞
+    lines = lyric_lines(lyrics)
+    intro = duration * INTRO_RATIO
+    body = max(0.0, duration - intro - duration * OUTRO_RATIO)
+    weights = [len(line) + 4 for line in lines]
+    entries = [(0.0, intro, title)] if title else []
+    position = intro
+    for line, weight in zip(lines, weights):
+        length = body * weight / sum(weights)
+        entries.append((position, position + length, line))
+        position += length
+    return "\n".join(
+        f"{index}\n{_timestamp(start)} --> {_timestamp(end)}\n{text}\n"
+        for index, (start, end, text) in enumerate(entries, start=1)
+    )
+
+def audio_duration(audio_path):
+    result = subprocess.run([FFMPEG, "-hide_banner", "-i", audio_path], capture_output=True, text=True,
+                            timeout=RENDER_TIMEOUT)
+    match = _DURATION_RE.search(result.stderr)
+    if not match:
+        raise ValueError(f"無法取得音檔長度: {audio_path}")
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def render_video(audio_path, output_path, lyrics, title):
+    # 回傳繪製耗時；輸出先寫到暫存檔，完成後才放進媒體庫
+    start = time.perf_counter()
+    audio_path = os.path.abspath(audio_path)
+    output_path = os.path.abspath(output_path)
+    duration = audio_duration(audio_path)
+    with tempfile.TemporaryDirectory(prefix="render-") as workdir:
+        with open(os.path.join(workdir, "lyrics.srt"), "w", encoding="utf-8") as f:
+            f.write(build_subtitles(lyrics, title, duration))
+        if os.path.exists(BACKGROUND_IMAGE):
+            background = ["-loop", "1", "-framerate", str(VIDEO_FPS), "-i", os.path.abspath(BACKGROUND_IMAGE)]
+        else:
+            background = ["-f", "lavfi", "-i", f"color=c={BACKGROUND_COLOR}:s={VIDEO_SIZE}:r={VIDEO_FPS}"]
+        style = f"FontName={FONT_NAME},FontSize=26,Alignment=2,MarginV=60,Outline=1"
+        tmp_path = os.path.join(workdir, "video.mp4")
+        # 字幕檔用相對路徑，避免 filter 參數中的路徑需要跳脫；mp3 直接放進 mp4 不重新編碼
+        subprocess.run(
+            [FFMPEG, "-hide_banner", "-loglevel", "error", "-y", *background, "-i", audio_path,
+             "-vf", f"scale={VIDEO_SIZE.replace('x', ':')},subtitles=lyrics.srt:force_style='{style}'",
+             "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage", "-pix_fmt", "yuv420p",
+             "-c:a", "copy", "-shortest", "-movflags", "+faststart", tmp_path],
+            cwd=workdir, check=True, capture_output=True, timeout=RENDER_TIMEOUT
+        )
+        if not os.path.exists(output_path):
+            # Suno 的影片先下載完成時保留 Suno 的版本
+            os.replace(tmp_path, output_path)
+    return time.perf_counter() - start
+
+def _executor():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+        return _pool
+
+def _on_rendered(clip_id, future, on_rendered):
+    try:
+        seconds = future.result()
+    except Exception:
+        with _lock:
+            _stats["errors"] += 1
+        metrics.inc("song_stage_errors_total", {"stage": "render"})
+        return
+    with _lock:
+        _stats["rendered"] += 1
+        _stats["seconds"] += seconds
+    metrics.observe("song_stage_duration_seconds", seconds, {"stage": "render"})
+    media.evict()
+    # 本地影片只是媒體庫中可被淘汰的檔案，不取代 Suno 的影片網址；Suno 的輪詢照常進行，作為長期保存的版本
+    if on_rendered:
+        on_rendered(clip_id)
+
+def render_clip(clip_id, audio_path, lyrics, title, on_rendered=None):
+    # 用媒體庫中的音檔在背景繪製影片，完成後呼叫 on_rendered(clip_id)；回傳 future，未啟用時回傳 None
+    if not enabled() or media.is_cached(clip_id, "mp4"):
+        return None
+    future = _executor().submit(render_video, audio_path, media.media_path(clip_id, "mp4"), lyrics, title)
+    future.add_done_callback(lambda future: _on_rendered(clip_id, future, on_rendered))
+    return future
+
+def renderer_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["enabled"] = enabled()
+    stats["avg_seconds"] = stats["seconds"] / stats["rendered"] if stats["rendered"] else 0.0
+    return stats
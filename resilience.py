@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import admission
+from metrics import inc, describe
+
+# Constants
+DEADLINES = {"lyrics": 60, "theme": 20, "lyrics_and_theme": 60, "lyrics_fix": 60}  # 每種請求最多等待的秒數
+DEFAULT_DEADLINE = 60
+HEDGE_QUANTILE = 0.95  # 超過近期 p95 延遲仍未完成時送出第二個相同請求
+HEDGE_MIN_SAMPLES = 20  # 樣本不足時不避險，避免每個正常的請求都多送一次
+LATENCY_WINDOW = 200  # 每種請求保留最近幾次的延遲
+FAILURE_THRESHOLD = 5  # 連續失敗幾次後斷路
+OPEN_SECONDS = 30  # 斷路後多久再放行一次試探請求
+# 每個送出的請求（包含避險與被放棄的請求）都先從 token bucket 取得額度，最多持續一個逾時時間；
+# 執行緒數涵蓋一個最長逾時內 bucket 可能放行的請求數，請求不會在這裡排隊
+MAX_WORKERS = int(admission.RATE_LIMITS["openai"][0] * max(DEADLINES.values())) + admission.RATE_LIMITS["openai"][1]
+
+# 斷路器狀態
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class UpstreamError(Exception):
+    pass
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if time.monotonic() - self.opened_at >= OPEN_SECONDS:
+                # 斷路一段時間後（或上一個試探請求沒有回報結果）只放行一個試探請求
+                self.state = HALF_OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= FAILURE_THRESHOLD:
+                if self.state != OPEN:
+                    inc("song_circuit_open_total", {"upstream": self.name})
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="hedge")
+_latencies = {}  # stage -> 最近的延遲秒數
+_stats = {"calls": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0, "fast_failures": 0, "failures": 0}
+breakers = {"openai": CircuitBreaker("openai")}
+
+def _record_latency(stage, seconds):
+    with _lock:
+        _latencies.setdefault(stage, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+def hedge_delay(stage):
+    # 回傳避險前等待的秒數，樣本不足時回傳 None
+    with _lock:
+        samples = sorted(_latencies.get(stage, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(HEDGE_QUANTILE * len(samples)))]
+
+def _count(name, stage=None):
+    with _lock:
+        _stats[name] += 1
+    if stage:
+        inc(f"song_{name}_total", {"stage": stage})
+
+def _check_breaker(upstream):
+    breaker = breakers[upstream]
+    if not breaker.allow():
+        _count("fast_failures")
+        raise CircuitOpenError(f"{upstream} 目前不穩定，請稍後再試。")
+    return breaker
+
+def _submit(func, budget):
+    # budget() 在開始執行時才計算逾時秒數，等待執行緒的時間不算在請求的逾時內
+    started = threading.Event()
+
+    def run():
+        started.set()
+        return func(budget())
+    return _executor.submit(run), started
+
+def call(upstream, stage, func, hedge=True):
+    # func(timeout) 送出一次請求；超過 p95 延遲時再送一次，取先成功的結果
+    breaker = _check_breaker(upstream)
+    _count("calls")
+    deadline = DEADLINES.get(stage, DEFAULT_DEADLINE)
+    primary, started = _submit(func, lambda: deadline)
+    # 期限從請求真正送出時開始計算，本地排隊不會被當成上游逾時而觸發斷路
+    started.wait()
+    start = time.monotonic()
+    attempts = {primary: "primary"}
+    pending = set(attempts)
+    error = None
+    delay = hedge_delay(stage) if hedge else None
+    while pending:
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        timeout = remaining
+        can_hedge = delay is not None and len(attempts) == 1
+        if can_hedge:
+            timeout = min(remaining, max(0.0, delay - (time.monotonic() - start)))
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                elapsed = time.monotonic() - start
+                _record_latency(stage, elapsed)
+                if attempts[future] == "hedge":
+                    _count("hedge_wins", stage)
+                breaker.record_success()
+                return future.result()
+            error = future.exception()
+        if can_hedge and (not done or not pending) and deadline - (time.monotonic() - start) > 1:
+            # 超過 p95 仍未完成，或第一次請求就失敗時再送一次；同樣受 token bucket 限制，沒有額度時不避險
+            if admission.buckets[upstream].try_acquire():
+                _count("hedges", stage)
+                hedged, _ = _submit(func, lambda: max(1.0, deadline - (time.monotonic() - start)))
+                attempts[hedged] = "hedge"
+                pending.add(hedged)
+            else:
+                delay = None
+    # 未完成的請求會在自己的 timeout 後結束，結果直接丟棄
+    breaker.record_failure()
+    if error is None:
+        _count("deadline_exceeded", stage)
+        raise DeadlineExceeded(f"{upstream} 請求超過 {deadline} 秒仍未完成，請稍後再試。")
+    _count("failures")
+    raise UpstreamError(f"{upstream} 請求失敗: {error}") from error
+
+def call_stream(upstream, stage, func):
+    # 串流請求不避險，只套用斷路器與逾時；func(timeout) 回傳一個產生器
+    breaker = _check_breaker(upstream)
+    _count("calls")
+    deadline = DEADLINES.get(stage, DEFAULT_DEADLINE)
+    try:
+        yield from func(deadline)
+    except Exception as e:
+        breaker.record_failure()
+        _count("failures")
+        raise UpstreamError(f"{upstream} 請求失敗: {e}") from e
+    breaker.record_success()
+
+def resilience_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["hedge_win_rate"] = stats["hedge_wins"] / stats["hedges"] if stats["hedges"] else 0.0
+    for name, breaker in breakers.items():
+        stats[f"{name}_circuit"] = breaker.state
+    return stats
+
+describe("song_hedges_total", "counter", "Hedge requests sent after a call exceeded the observed p95 latency.")
+describe("song_hedge_wins_total", "counter", "Hedge requests that finished before the original request.")
+describe("song_deadline_exceeded_total", "counter", "Calls that did not finish before their deadline.")
+describe("song_circuit_open_total", "counter", "Times the circuit breaker opened for an upstream.")
@@ -0,0 +1,141 @@
+import threading
+from metrics import inc, describe
+from resilience import UpstreamError
+
+# 同時有多個相同的請求（例如熱門的預設選擇）時，只向上游送出一次，其他人等待並共用結果。
+# key 使用與快取相同的正規化提示詞 key，想要不同版本的使用者可以略過合併。
+
+_lock = threading.Lock()
+_calls = {}  # key -> 進行中的請求
+_stats = {"leaders": 0, "collapsed": 0, "errors": 0, "abandoned": 0}
+
+class AbandonedCall(UpstreamError):
+    # 發起者中途離開（例如 Streamlit 重新執行時關閉了串流），共用的請求沒有結果
+    pass
+
+class _Call:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.chunks = []  # 串流請求已產生的片段，讓晚到的人也能從頭接著顯示
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.done = False
+
+def _join(key):
+    # 回傳 (call, 是否為發起者)
+    with _lock:
+        call = _calls.get(key)
+        if call is not None:
+            _stats["collapsed"] += 1
+            inc("song_coalesced_requests_total")
+            return call, False
+        call = _Call()
+        _calls[key] = call
+        _stats["leaders"] += 1
+        return call, True
+
+def _finish(key, call, result=None, error=None, abandoned=False):
+    with _lock:
+        _calls.pop(key, None)
+        if error is not None:
+            _stats["errors"] += 1
+        if abandoned:
+            _stats["abandoned"] += 1
+    with call.condition:
+        call.result = result
+        call.error = error
+        call.abandoned = abandoned
+        call.done = True
+        call.condition.notify_all()
+
+def _follow(call):
+    index = 0
+    while True:
+        with call.condition:
+            while index == len(call.chunks) and not call.done:
+                call.condition.wait()
+            chunks = call.chunks[index:]
+            done = call.done
+        index += len(chunks)
+        yield from chunks
+        if done:
+            break
+    if call.abandoned:
+        raise AbandonedCall("共用的請求已中斷")
+    if call.error is not None:
+        raise call.error
+    if index == 0 and call.result:
+        # 發起者是非串流請求時，最後一次給出完整結果
+        yield call.result
+
+def do(key, func, share=True):
+    # share=False 時直接呼叫，不與其他請求合併
+    if not share:
+        return func()
+    call, leader = _join(key)
+    if not leader:
+        try:
+            for _ in _follow(call):
+                pass
+        except AbandonedCall:
+            # 發起者沒有完成請求，由等待的人自己重送（可能成為新的發起者）
+            return do(key, func, share)
+        return call.result
+    try:
+        result = func()
+    except Exception as e:
+        _finish(key, call, error=e)
+        raise
+    except BaseException:
+        # 例如 Streamlit 重新執行時中斷了發起者，不讓等待的人一直等下去
+        _finish(key, call, abandoned=True)
+        raise
+    _finish(key, call, result=result)
+    return result
+
+def stream(key, func, share=True):
+    # 串流版本：發起者邊產生邊把片段分享給等待中的人
+    if not share:
+        yield from func()
+        return
+    call, leader = _join(key)
+    if not leader:
+        shown = False
+        try:
+            for chunk in _follow(call):
+                shown = True
+                yield chunk
+            return
+        except AbandonedCall:
+            # 還沒顯示任何片段時自己重送；已經顯示一部分時無法接續，交給呼叫端當成上游錯誤處理
+            if shown:
+                raise
+        yield from stream(key, func, share)
+        return
+    error = None
+    abandoned = True  # 串流被關閉時不會執行到迴圈結束
+    try:
+        for chunk in func():
+            with call.condition:
+                call.chunks.append(chunk)
+                call.condition.notify_all()
+            yield chunk
+        abandoned = False
+    except Exception as e:
+        error = e
+        abandoned = False
+        raise
+    finally:
+        done = error is None and not abandoned
+        _finish(key, call, result="".join(call.chunks) if done else None, error=error, abandoned=abandoned)
+
+def singleflight_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["in_flight"] = len(_calls)
+    total = stats["leaders"] + stats["collapsed"]
+    stats["collapse_rate"] = stats["collapsed"] / total if total else 0.0
+    return stats
+
+describe("song_coalesced_requests_total", "counter", "Requests that shared an identical in-flight upstream call.")
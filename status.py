@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+import threading
+from urllib.parse import urlparse, parse_qs
+import metrics
+from admission import queue_info
+from jobs import add_listener, get_job, FINISHED_STATES
+
+# 工作狀態推送：背景工作每次更新狀態時通知這裡，頁面以 Server-Sent Events 或長輪詢訂閱，
+# 不必讓 Streamlit 腳本定時重跑。所有連線由同一個 asyncio 執行緒處理，等待中的頁面不佔用執行緒。
+#
+#   GET /jobs/<job_id>/events          Server-Sent Events，每次狀態改變送出一筆，工作結束後關閉
+#   GET /jobs/<job_id>?after=<version>  長輪詢，版本號大於 after 或逾時才回應
+
+# Constants
+STATUS_HOST = "0.0.0.0"
+STATUS_PORT = int(os.environ.get("STATUS_PORT", "8503"))
+# 瀏覽器要能連到這個網址（HTTPS 頁面也需要 HTTPS）；沒有設定公開網址時預設不啟用推送，
+# 以 STATUS_PUSH=1 明確啟用時才假設瀏覽器與伺服器在同一台機器
+STATUS_PUSH = os.environ.get("STATUS_PUSH", "1" if os.environ.get("STATUS_PUBLIC_URL") else "0") != "0"
+STATUS_PUBLIC_URL = os.environ.get("STATUS_PUBLIC_URL", f"http://localhost:{STATUS_PORT}")
+LONG_POLL_TIMEOUT = 25  # 長輪詢最久等待秒數，低於一般代理伺服器的閒置逾時
+HEARTBEAT_INTERVAL = 15  # 沒有事件時送出的心跳間隔，排隊中的工作同時更新排隊位置
+READ_TIMEOUT = 10
+
+_lock = threading.Lock()
+_loop = None
+_server = None
+_versions = {}  # job_id -> 版本號，每次狀態改變加一
+_changed = {}  # job_id -> asyncio.Event，只在事件迴圈中存取
+_stats = {"published": 0, "events_sent": 0, "long_polls": 0, "subscribers": 0}
+
+def _payload(job_id):
+    # 先讀版本號再讀狀態，讀取期間的更新最多讓下一次等待立即回傳，不會漏掉
+    with _lock:
+        version = _versions.get(job_id, 0)
+    job = get_job(job_id)
+    if not job:
+        return None
+    return {
+        "id": job_id,
+        "version": version,
+        "status": job["status"],
+        "error": job.get("error"),
+        "finished": job["status"] in FINISHED_STATES,
+        "queue": queue_info(job_id),
+        "clips": [{"id": clip["id"], "status": clip["status"], "video_url": clip.get("video_url")}
+                  for clip in job["clips"]],
+    }
+
+def _wake(job_id):
+    event = _changed.pop(job_id, None)
+    if event:
+        event.set()
+
+def _on_job_update(job):
+    # 由背景工作執行緒呼叫，只遞增版本號並喚醒等待中的連線，內容在送出時才讀取
+    with _lock:
+        _versions[job["id"]] = _versions.get(job["id"], 0) + 1
+        _stats["published"] += 1
+        loop = _loop
+    if loop:
+        loop.call_soon_threadsafe(_wake, job["id"])
+
+async def _wait_change(job_id, version, timeout):
+    # 版本號已經比 version 新時立即回傳，避免讀取狀態後、開始等待前的更新被漏掉
+    with _lock:
+        if _versions.get(job_id, 0) > version:
+            return True
+    event = _changed.setdefault(job_id, asyncio.Event())
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+def _headers(status, content_type, extra=()):
+    lines = [f"HTTP/1.1 {status}", f"Content-Type: {content_type}", "Access-Control-Allow-Origin: *",
+             "Cache-Control: no-cache", *extra]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+async def _send_json(writer, status, body):
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    writer.write(_headers(status, "application/json; charset=utf-8",
+                          [f"Content-Length: {len(data)}", "Connection: close"]) + data)
+    await writer.drain()
+
+async def _load_payload(job_id):
+    # 不在記憶體中的工作會從 SQLite 讀取，放到執行緒中執行，不阻塞事件迴圈
+    return await asyncio.get_running_loop().run_in_executor(None, _payload, job_id)
+
+async def _serve_events(job_id, writer):
+    payload = await _load_payload(job_id)
+    if payload is None:
+        await _send_json(writer, "404 Not Found", {"error": "job not found"})
+        return
+    writer.write(_headers("200 OK", "text/event-stream; charset=utf-8", ["Connection: keep-alive"]))
+    with _lock:
+        _stats["subscribers"] += 1
+    metrics.gauge_add("song_status_subscribers")
+    try:
+        while payload:
+            writer.write(f"id: {payload['version']}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await writer.drain()
+            with _lock:
+                _stats["events_sent"] += 1
+            metrics.inc("song_status_events_total", {"transport": "sse"})
+            if payload["finished"]:
+                return
+            version = payload["version"]
+            while True:
+                changed = await _wait_change(job_id, version, HEARTBEAT_INTERVAL)
+                payload = await _load_payload(job_id)
+                # 排隊中的工作在心跳時送出最新的排隊位置，其他狀態只送心跳，讓代理伺服器與瀏覽器知道連線仍然有效
+                if changed or not payload or payload["queue"] is not None:
+                    break
+                writer.write(b": heartbeat\n\n")
+                await writer.drain()
+    finally:
+        with _lock:
+            _stats["subscribers"] -= 1
+        metrics.gauge_add("song_status_subscribers", amount=-1)
+
+async def _serve_poll(job_id, after, writer):
+    with _lock:
+        _stats["long_polls"] += 1
+        version = _versions.get(job_id, 0)
+    if version <= after:
+        await _wait_change(job_id, after, LONG_POLL_TIMEOUT)
+    payload = await _load_payload(job_id)
+    if payload is None:
+        await _send_json(writer, "404 Not Found", {"error": "job not found"})
+        return
+    metrics.inc("song_status_events_total", {"transport": "long_poll"})
+    await _send_json(writer, "200 OK", payload)
+
+async def _handle(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        url = urlparse(target)
+        parts = url.path.strip("/").split("/")
+        if method != "GET" or len(parts) not in (2, 3) or parts[0] != "jobs":
+            await _send_json(writer, "404 Not Found", {"error": "not found"})
+        elif len(parts) == 3 and parts[2] == "events":
+            await _serve_events(parts[1], writer)
+        elif len(parts) == 2:
+            try:
+                after = int(parse_qs(url.query).get("after", ["0"])[0])
+            except ValueError:
+                await _send_json(writer, "400 Bad Request", {"error": "invalid after"})
+                return
+            await _serve_poll(parts[1], after, writer)
+        else:
+            await _send_json(writer, "404 Not Found", {"error": "not found"})
+    except (ConnectionError, asyncio.TimeoutError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+def _run(ready):
+    global _loop, _server
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        server = loop.run_until_complete(asyncio.start_server(_handle, STATUS_HOST, STATUS_PORT))
+    except OSError:
+        # 其他進程已經在同一個埠口提供服務，那個進程看不到這裡的工作，頁面改用定時重跑
+        _server = False
+        ready.set()
+        return
+    with _lock:
+        _loop = loop
+        _server = server
+    ready.set()
+    loop.run_forever()
+
+def start_server():
+    # 回傳是否可以使用推送；第一次呼叫時在背景執行緒啟動事件迴圈
+    global _server
+    if not STATUS_PUSH:
+        return False
+    with _lock:
+        started = _server is not None
+        if not started:
+            _server = True  # 啟動中，避免重複啟動
+    if not started:
+        add_listener(_on_job_update)
+        ready = threading.Event()
+        threading.Thread(target=_run, args=(ready,), name="status-server", daemon=True).start()
+        ready.wait()
+    return bool(_server)
+
+def status_url(job_id):
+    return f"{STATUS_PUBLIC_URL}/jobs/{job_id}"
+
+def status_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats["enabled"] = bool(_server)
+    return stats
+
+metrics.describe("song_status_subscribers", "gauge", "Open Server-Sent Events connections on the job status endpoint.")
+metrics.describe("song_status_events_total", "counter", "Job status payloads pushed to pages, by transport.")
@@ -0,0 +1,210 @@
+import difflib
+import re
+import threading
+import metrics
+
+# 歌詞段落結構的本地檢查與修復：模型偶爾會寫錯段落標記（拼錯、少了方括號、漏掉 [intro]/[End]），
+# 能在本地修好的就不必再花一次完整的生成請求。
+
+# Constants
+DEFAULT_STRUCTURE = ("Verse1", "Chorus", "Verse2", "Chorus", "Bridge", "Chorus", "Outro")
+END_MARKER = "[End]"
+SUNO_LYRICS_LIMIT = 3000  # Suno 自訂模式歌詞的字數上限
+MAX_SECTION_LINES = 12  # 段落太長時 Suno 常會唱得很趕
+MIN_SECTION_LINES = 1
+
+# 各種常見寫法對應到標準段落名稱；提示詞中的 [Bride] 其實是 Bridge 的筆誤
+_ALIASES = {
+    "verse": "Verse", "主歌": "Verse", "副歌": "Chorus", "chorus": "Chorus", "refrain": "Chorus",
+    "hook": "Chorus", "bridge": "Bridge", "bride": "Bridge", "橋段": "Bridge", "過門": "Bridge",
+    "outro": "Outro", "尾聲": "Outro", "結尾": "Outro", "intro": "Intro", "前奏": "Intro",
+    "end": "End", "結束": "End", "pre-chorus": "Pre-Chorus", "prechorus": "Pre-Chorus",
+}
+_MARKER_RE = re.compile(r"^[\[【(（]?\s*([A-Za-z\-一-鿿]+)\s*(\d*)\s*([^\]】)）]*?)[\]】)）]?\s*[:：]?$")
+_FUZZY_CUTOFF = 0.75
+
+_lock = threading.Lock()
+_stats = {"checked": 0, "valid": 0, "repaired": 0, "needs_llm": 0, "llm_fixed": 0, "llm_failed": 0}
+
+def _canonical_name(word, fuzzy):
+    key = word.lower()
+    if key in _ALIASES or not fuzzy:
+        return _ALIASES.get(key)
+    # 拼錯的英文標記（Chrous、Vers）用近似比對
+    match = difflib.get_close_matches(key, [alias for alias in _ALIASES if alias.isascii()], n=1, cutoff=_FUZZY_CUTOFF)
+    return _ALIASES[match[0]] if match else None
+
+def parse_marker(line):
+    # 回傳 (標準段落名稱, 段落後的附加文字)；不是段落標記時回傳 None
+    text = line.strip().strip("*#").strip()
+    if not text or len(text) > 40:
+        return None
+    bracketed = text[0] in "[【(（" and text[-1] in "]】)）"
+    match = _MARKER_RE.match(text)
+    if not match:
+        return None
+    # 只有加了括號或冒號的才算段落標記，避免把「結束」「副歌」或 "look" 之類的歌詞當成標記
+    if not bracketed and text[-1] not in ":：":
+        return None
+    name = _canonical_name(match.group(1), True)
+    if name is None:
+        return None
+    extra = match.group(3).strip()
+    if extra and not bracketed:
+        # 沒有方括號又帶著其他文字的，多半是一般歌詞
+        return None
+    if name == "Verse":
+        name = f"Verse{match.group(2) or ''}"
+    return name, extra
+
+def parse_sections(lyrics):
+    # 回傳 (前言, [(段落名稱, 附加文字, 歌詞行)], 是否有 [End], 修改紀錄)
+    lines = [raw.strip() for raw in lyrics.replace("```", "").splitlines() if raw.strip()]
+    markers = [parse_marker(line) for line in lines]
+    ends = [index for index, marker in enumerate(markers) if marker and marker[0] == "End"]
+    changes = []
+    if ends:
+        # 只有最後一個 [End] 有效；中間的 [End] 拿掉，之後的段落照常保留
+        if len(ends) > 1:
+            changes.append(f"移除段落中間的 {END_MARKER} {len(ends) - 1} 個")
+        trailing = len(lines) - ends[-1] - 1
+        if trailing:
+            changes.append(f"移除 {END_MARKER} 後的文字 {trailing} 行")
+        lines, markers = lines[:ends[-1]], markers[:ends[-1]]
+    preamble = []
+    sections = []
+    for line, marker in zip(lines, markers):
+        if marker:
+            name, extra = marker
+            if name == "End":
+                continue
+            expected = f"[{name}{' ' + extra if extra else ''}]"
+            # [intro] 的寫法由風格檔決定，輸出時一律換成 intro_marker
+            if name != "Intro" and line != expected:
+                changes.append(f"{line} → {expected}")
+            sections.append((name, extra, []))
+        elif sections:
+            sections[-1][2].append(line)
+        else:
+            preamble.append(line)
+    return preamble, sections, bool(ends), changes
+
+def _number_verses(sections, changes):
+    # 沒有編號的 [Verse] 依出現順序補上編號
+    count = 0
+    numbered = []
+    for name, extra, lines in sections:
+        if name.startswith("Verse"):
+            count += 1
+            if name == "Verse":
+                name = f"Verse{count}"
+                changes.append(f"[Verse] → [{name}]")
+        numbered.append((name, extra, lines))
+    return numbered
+
+def render(intro_marker, sections):
+    parts = [intro_marker]
+    for name, extra, lines in sections:
+        if name == "Intro":
+            if lines:
+                parts[0] = "\n".join([intro_marker, *lines])
+            continue
+        parts.append("\n".join([f"[{name}{' ' + extra if extra else ''}]", *lines]))
+    parts.append(END_MARKER)
+    return "\n\n".join(parts)
+
+def check(sections, structure):
+    # 回傳無法在本地修復的問題
+    issues = []
+    names = [name for name, _, _ in sections if name != "Intro"]
+    missing = [name for name in dict.fromkeys(structure) if name not in names]
+    if missing:
+        issues.append(f"缺少段落: {', '.join(missing)}")
+    for name, _, lines in sections:
+        if name != "Intro" and len(lines) < MIN_SECTION_LINES:
+            issues.append(f"[{name}] 沒有歌詞")
+        elif len(lines) > MAX_SECTION_LINES:
+            issues.append(f"[{name}] 有 {len(lines)} 行，超過 {MAX_SECTION_LINES} 行")
+    return issues
+
+def repair(lyrics, style, after_llm=False):
+    # 回傳 (修復後的歌詞, 報告)；報告中的 issues 不為空時代表需要模型修正。
+    # after_llm 為 True 時是檢查模型修正後的結果，只記錄修正是否成功
+    structure = style.get("structure", DEFAULT_STRUCTURE)
+    intro_marker = style.get("intro_marker", "[intro]")
+    preamble, sections, has_end, changes = parse_sections(lyrics)
+    if preamble and sections:
+        # 第一個段落之前的「好的，以下是歌詞：」之類的說明文字
+        changes.append(f"移除段落前的文字 {len(preamble)} 行")
+    elif preamble:
+        # 完全沒有段落標記時無法判斷結構
+        sections = [("Verse1", "", preamble)]
+    if not has_end:
+        changes.append(f"補上 {END_MARKER}")
+    if not sections or sections[0][0] != "Intro":
+        changes.append(f"補上 {intro_marker}")
+    sections = _number_verses(sections, changes)
+    # 少了重複的副歌時直接複製第一段副歌
+    chorus = next((lines for name, _, lines in sections if name == "Chorus" and lines), None)
+    if chorus:
+        for index, (name, extra, lines) in enumerate(sections):
+            if name == "Chorus" and not lines:
+                sections[index] = (name, extra, list(chorus))
+                changes.append("空白的 [Chorus] 複製第一段副歌")
+        expected_choruses = list(structure).count("Chorus")
+        actual_choruses = sum(1 for name, _, _ in sections if name == "Chorus")
+        if actual_choruses < expected_choruses:
+            sections = _insert_choruses(sections, structure, chorus, changes)
+    text = render(intro_marker, sections)
+    issues = check(sections, structure)
+    if len(text) > SUNO_LYRICS_LIMIT:
+        issues.append(f"歌詞共 {len(text)} 字，超過 Suno 上限 {SUNO_LYRICS_LIMIT} 字")
+    report = {
+        "changes": changes,
+        "issues": issues,
+        "sections": [(name, len(lines), sum(len(line) for line in lines)) for name, _, lines in sections],
+        "length": len(text),
+    }
+    if after_llm:
+        _record("llm_failed" if issues else "llm_fixed")
+    else:
+        with _lock:
+            _stats["checked"] += 1
+        _record("needs_llm" if issues else "repaired" if changes else "valid")
+    return text, report
+
+def _record(result):
+    with _lock:
+        _stats[result] += 1
+    metrics.inc("song_lyrics_structure_total", {"result": result})
+
+def record_llm_failure():
+    # 模型修正請求本身失敗（逾時、斷路）時記錄，不必再檢查一次原本的歌詞
+    _record("llm_failed")
+
+def _insert_choruses(sections, structure, chorus, changes):
+    # 依預期結構在缺副歌的位置補上副歌，例如 Verse2 後面直接接 Bridge 時
+    result = []
+    names = [name for name, _, _ in sections]
+    for index, section in enumerate(sections):
+        result.append(section)
+        name = section[0]
+        if name not in structure or name == "Chorus":
+            continue
+        position = list(structure).index(name)
+        should_follow = position + 1 < len(structure) and structure[position + 1] == "Chorus"
+        next_name = names[index + 1] if index + 1 < len(names) else None
+        if should_follow and next_name != "Chorus":
+            result.append(("Chorus", "", list(chorus)))
+            changes.append(f"[{name}] 後補上 [Chorus]")
+    return result
+
+def structure_stats():
+    with _lock:
+        stats = dict(_stats)
+    # 有問題的歌詞中，不必再呼叫模型就修好的比例
+    broken = stats["repaired"] + stats["needs_llm"]
+    stats["local_fix_rate"] = stats["repaired"] / broken if broken else 0.0
+    return stats
+
+metrics.describe("song_lyrics_structure_total", "counter", "Lyrics structure checks by result (valid, repaired locally, needs an LLM fix, LLM fix outcome).")
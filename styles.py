@@ -0,0 +1,35 @@
+import json
+import os
+
+# 每個風格（國語、台語……）是 styles/ 目錄下的一個 JSON 檔，檔名即為風格代號
+STYLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "styles")
+DEFAULT_STYLE = "mandarin"
+REQUIRED_FIELDS = ("name", "lyrics_prompt", "suno_tags", "max_title_length", "categories")
+
+_styles = None
+
+def _load_styles():
+    styles = {}
+    for filename in sorted(os.listdir(STYLES_DIR)):
+        if not filename.endswith(".json"):
+            continue
+        style_id = filename[:-len(".json")]
+        with open(os.path.join(STYLES_DIR, filename), encoding="utf-8") as f:
+            style = json.load(f)
+        missing = [field for field in REQUIRED_FIELDS if field not in style]
+        if missing:
+            raise ValueError(f"風格檔 {filename} 缺少欄位: {', '.join(missing)}")
+        style["id"] = style_id
+        styles[style_id] = style
+    return styles
+
+def list_styles():
+    # 進程內只載入一次，所有 session 共用
+    global _styles
+    if _styles is None:
+        _styles = _load_styles()
+    return _styles
+
+def get_style(style_id=None):
+    styles = list_styles()
+    return styles[style_id or DEFAULT_STYLE]
@@ -0,0 +1,61 @@
+import structure
+
+STYLE = {"intro_marker": "[intro]"}
+
+SONG = """[intro]
+[Verse1]
+我們的故事
+結束
+從這裡開始
+[Chorus]
+副歌
+唱到天亮
+[Verse2]
+第二段
+[Chorus]
+唱到天亮
+[Bridge]
+橋段
+[Chorus]
+唱到天亮
+[Outro]
+尾聲
+[End]"""
+
+def test_parse_marker_requires_brackets_or_colon():
+    assert structure.parse_marker("[Chorus]") == ("Chorus", "")
+    assert structure.parse_marker("【副歌】") == ("Chorus", "")
+    assert structure.parse_marker("Verse 2:") == ("Verse2", "")
+    assert structure.parse_marker("[Chrous]") == ("Chorus", "")
+    for line in ("結束", "End", "副歌", "尾聲", "Hook", "Refrain", "look"):
+        assert structure.parse_marker(line) is None
+
+def test_bare_alias_lines_stay_lyrics():
+    text, report = structure.repair(SONG, STYLE)
+    assert report["issues"] == []
+    assert report["changes"] == []
+    assert text.split("\n\n")[1] == "[Verse1]\n我們的故事\n結束\n從這裡開始"
+    assert "尾聲" in text and text.endswith("[End]")
+
+def test_text_after_end_is_reported():
+    text, report = structure.repair(SONG + "\n多出來的一行", STYLE)
+    assert "多出來的一行" not in text
+    assert f"移除 {structure.END_MARKER} 後的文字 1 行" in report["changes"]
+
+def test_misplaced_end_keeps_following_sections():
+    lyrics = SONG.replace("[Verse2]", "[End]\n[Verse2]")
+    text, report = structure.repair(lyrics, STYLE)
+    assert report["issues"] == []
+    assert "[Verse2]\n第二段" in text
+    assert any("段落中間" in change for change in report["changes"])
+
+def test_repair_fixes_markers_locally():
+    lyrics = SONG.replace("[Bridge]", "Bride:").replace("[Verse1]", "[Verse]").replace("[intro]\n", "")
+    text, report = structure.repair(lyrics, STYLE)
+    assert report["issues"] == []
+    assert text.startswith("[intro]\n\n[Verse1]")
+    assert "[Bridge]\n橋段" in text
+
+def test_missing_sections_need_llm():
+    text, report = structure.repair("[Verse1]\n只有一段", STYLE)
+    assert any("缺少段落" in issue for issue in report["issues"])
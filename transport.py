@@ -0,0 +1,114 @@
+import os
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# 所有上游流量共用的連線池：OpenAI SDK 需要 httpx 客戶端，suno 套件與媒體下載使用 requests，
+# 兩者各自只建立一個連線池，由這裡統一設定上限並統計連線重用情況。
+
+# Constants
+MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "50"))  # 同時開啟的連線上限
+MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "20"))  # 保留的閒置連線數（requests 為每個主機）
+KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))  # 閒置連線保留秒數
+POOL_HOSTS = 10  # requests 連線池快取的主機數
+CONNECT_TIMEOUT = 10
+
+try:
+    import h2  # noqa: F401  安裝 h2 時 OpenAI 連線改用 HTTP/2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+_lock = threading.Lock()
+_http_client = None
+_adapter = None
+_media_session = None
+_stats = {"httpx_requests": 0, "httpx_https_requests": 0, "httpx_connections": 0, "httpx_tls_handshakes": 0}
+
+def _trace(event_name, info):
+    # httpcore 在建立新連線與 TLS 握手時呼叫，重用連線時不會出現這些事件
+    if event_name == "connection.connect_tcp.complete":
+        with _lock:
+            _stats["httpx_connections"] += 1
+    elif event_name == "connection.start_tls.complete":
+        with _lock:
+            _stats["httpx_tls_handshakes"] += 1
+
+def _on_request(request):
+    request.extensions["trace"] = _trace
+    with _lock:
+        _stats["httpx_requests"] += 1
+        if request.url.scheme == "https":
+            _stats["httpx_https_requests"] += 1
+
+def http_client():
+    # 傳給 OpenAI(http_client=...)，所有 OpenAI 客戶端共用同一個連線池
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                http2=HTTP2,
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE,
+                                    keepalive_expiry=KEEPALIVE_EXPIRY),
+                timeout=httpx.Timeout(600, connect=CONNECT_TIMEOUT),
+                follow_redirects=True,
+                event_hooks={"request": [_on_request]},
+            )
+        return _http_client
+
+def _requests_adapter():
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            _adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=MAX_KEEPALIVE)
+        return _adapter
+
+def mount(session):
+    # 讓 requests.Session（例如 suno 套件內部的 client）改用共用的連線池
+    adapter = _requests_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def media_session():
+    global _media_session
+    if _media_session is None:
+        session = mount(requests.Session())
+        with _lock:
+            if _media_session is None:
+                _media_session = session
+    return _media_session
+
+def _urllib3_counts():
+    requests_count = connections = tls_requests = tls_connections = 0
+    adapter = _adapter
+    if adapter is None:
+        return requests_count, connections, tls_requests, tls_connections
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        requests_count += pool.num_requests
+        connections += pool.num_connections
+        if pool.scheme == "https":
+            tls_requests += pool.num_requests
+            tls_connections += pool.num_connections
+    return requests_count, connections, tls_requests, tls_connections
+
+def transport_stats():
+    with _lock:
+        stats = dict(_stats)
+    requests_count, connections, tls_requests, tls_connections = _urllib3_counts()
+    stats["requests_requests"] = requests_count
+    stats["requests_connections"] = connections
+    total_requests = stats["httpx_requests"] + requests_count
+    total_connections = stats["httpx_connections"] + connections
+    stats["reuse_ratio"] = 1 - total_connections / total_requests if total_requests else 0.0
+    # 每個重用的 https 請求都省下一次 TLS 握手
+    stats["tls_handshakes_saved"] = (
+        max(0, stats["httpx_https_requests"] - stats["httpx_tls_handshakes"]) + max(0, tls_requests - tls_connections)
+    )
+    stats["http2"] = HTTP2
+    return stats
@@ -0,0 +1,157 @@
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import numpy as np
+import media
+import metrics
+from renderer import FFMPEG
+
+# 每個音檔只解碼一次：用 ffmpeg 串流輸出 PCM，分段計算多種解析度的最小/最大值，
+# 存成與快取音檔放在一起的小型二進位檔（.peaks），頁面繪製波形與跳轉標記時直接讀取。
+
+# Constants
+SAMPLE_RATE = 11025  # 波形不需要完整取樣率，降低解碼後的資料量
+BASE_BLOCK = 64  # 最細解析度每個峰值涵蓋的取樣數
+LEVEL_FACTOR = 4  # 每一層比上一層粗 4 倍
+LEVELS = 4
+CHUNK_SAMPLES = BASE_BLOCK * 4096  # 每次從 ffmpeg 讀取的取樣數
+DECODE_TIMEOUT = 120
+
+# 檔案格式：標頭 magic(4s) 版本(B) 取樣率(I) 層數(H)，
+# 接著每層 每個峰值的取樣數(I) 峰值數(I)，最後依序是每層的 int8 [min, max] 配對
+MAGIC = b"PEAK"
+VERSION = 1
+_HEADER = struct.Struct("<4sBIH")
+_LEVEL = struct.Struct("<II")
+
+_lock = threading.Lock()
+_stats = {"computed": 0, "errors": 0, "decoded_seconds": 0.0}
+
+def peaks_path(clip_id, ext):
+    # 每個來源檔案各自一份波形，後製裁切過的版本與原始音檔的時間軸不同
+    return media.media_path(clip_id, f"{ext}.peaks")
+
+def enabled():
+    return shutil.which(FFMPEG) is not None
+
+def _block_peaks(samples):
+    # samples 長度為 BASE_BLOCK 的整數倍，一次算出所有區塊的最小與最大值
+    blocks = samples.reshape(-1, BASE_BLOCK)
+    return blocks.min(axis=1), blocks.max(axis=1)
+
+def _downsample(mins, maxs, factor):
+    count = len(mins) // factor * factor
+    if count == 0:
+        return mins[:1], maxs[:1]
+    return mins[:count].reshape(-1, factor).min(axis=1), maxs[:count].reshape(-1, factor).max(axis=1)
+
+def compute_peaks(audio_path):
+    # 回傳 [(每個峰值的取樣數, mins, maxs), ...]，由細到粗
+    process = subprocess.Popen(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-i", audio_path,
+         "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"],
+        stdout=subprocess.PIPE
+    )
+    mins, maxs = [], []
+    leftover = np.empty(0, dtype=np.int16)
+    total = 0
+    try:
+        while True:
+            data = process.stdout.read(CHUNK_SAMPLES * 2)
+            if not data:
+                break
+            samples = np.concatenate([leftover, np.frombuffer(data[:len(data) // 2 * 2], dtype=np.int16)])
+            usable = len(samples) // BASE_BLOCK * BASE_BLOCK
+            if usable:
+                chunk_mins, chunk_maxs = _block_peaks(samples[:usable])
+                mins.append(chunk_mins)
+                maxs.append(chunk_maxs)
+            leftover = samples[usable:]
+            total += len(data) // 2
+        process.wait(timeout=DECODE_TIMEOUT)
+    finally:
+        if process.poll() is None:
+            process.kill()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg 解碼失敗: {audio_path}")
+    if len(leftover):
+        padded = np.pad(leftover, (0, BASE_BLOCK - len(leftover)))
+        chunk_mins, chunk_maxs = _block_peaks(padded)
+        mins.append(chunk_mins)
+        maxs.append(chunk_maxs)
+    if not mins:
+        raise RuntimeError(f"音檔沒有任何取樣: {audio_path}")
+    # 16 位元取樣縮成 8 位元，波形顯示不需要更高的精度
+    level_mins = (np.concatenate(mins) >> 8).astype(np.int8)
+    level_maxs = (np.concatenate(maxs) >> 8).astype(np.int8)
+    levels = [(BASE_BLOCK, level_mins, level_maxs)]
+    for _ in range(LEVELS - 1):
+        level_mins, level_maxs = _downsample(level_mins, level_maxs, LEVEL_FACTOR)
+        levels.append((levels[-1][0] * LEVEL_FACTOR, level_mins, level_maxs))
+    return levels, total / SAMPLE_RATE
+
+def write_peaks(path, levels):
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, SAMPLE_RATE, len(levels)))
+        for samples_per_peak, mins, _ in levels:
+            f.write(_LEVEL.pack(samples_per_peak, len(mins)))
+        for _, mins, maxs in levels:
+            f.write(np.column_stack([mins, maxs]).astype(np.int8).tobytes())
+    os.replace(tmp_path, path)
+
+def read_peaks(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, sample_rate, level_count = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"不支援的波形檔: {path}")
+    offset = _HEADER.size
+    shapes = []
+    for _ in range(level_count):
+        shapes.append(_LEVEL.unpack_from(data, offset))
+        offset += _LEVEL.size
+    levels = []
+    for samples_per_peak, count in shapes:
+        pairs = np.frombuffer(data, dtype=np.int8, count=count * 2, offset=offset).reshape(-1, 2)
+        levels.append((samples_per_peak, pairs[:, 0], pairs[:, 1]))
+        offset += count * 2
+    return sample_rate, levels
+
+def ensure_peaks(clip_id, ext):
+    # 對媒體庫中頁面實際播放的音檔計算一次波形，已經有波形檔時直接略過
+    path = peaks_path(clip_id, ext)
+    if os.path.exists(path) or not enabled():
+        return path if os.path.exists(path) else None
+    try:
+        with metrics.track("waveform"):
+            levels, seconds = compute_peaks(media.media_path(clip_id, ext))
+            write_peaks(path, levels)
+    except Exception:
+        with _lock:
+            _stats["errors"] += 1
+        return None
+    with _lock:
+        _stats["computed"] += 1
+        _stats["decoded_seconds"] += seconds
+    return path
+
+def load_waveform(clip_id, ext, width):
+    # 選出峰值數不少於 width 的最粗一層，再合併成剛好 width 個點；回傳 (每點秒數, mins, maxs)
+    path = peaks_path(clip_id, ext)
+    if not os.path.exists(path):
+        return None
+    sample_rate, levels = read_peaks(path)
+    samples_per_peak, mins, maxs = levels[0]
+    for level in levels:
+        if len(level[1]) >= width:
+            samples_per_peak, mins, maxs = level
+    factor = max(1, len(mins) // width)
+    mins, maxs = _downsample(mins, maxs, factor)
+    return samples_per_peak * factor / sample_rate, mins, maxs
+
+def waveform_stats():
+    with _lock:
+        return dict(_stats)